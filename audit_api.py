@@ -0,0 +1,217 @@
+# audit_api.py
+# HTTP audit service for the claims system:
+#   gunicorn -w 2 -b 0.0.0.0:8000 audit_api:app
+#
+#   POST /jobs                      upload a claims CSV (form field "file"), returns a job id
+#   GET  /jobs/<id>                 job status and counts
+#   GET  /jobs/<id>/deductions      results as CSV (?format=json for JSON records)
+#   GET  /jobs/<id>/anomalies
+#
+# Job state and results live on disk under AUDIT_JOBS_DIR, so any gunicorn
+# worker can answer status polls for jobs submitted to another one.
+import concurrent.futures
+import datetime
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+from flask import Flask, jsonify, request, send_file, abort
+
+import audit_engine as engine
+
+JOBS_DIR = os.environ.get('AUDIT_JOBS_DIR', 'audit_jobs')
+# background processes per gunicorn worker
+API_WORKERS = int(os.environ.get('AUDIT_API_WORKERS', '2'))
+# IsolationForest threads per background process; jobs already run side by side in
+# gunicorn workers x API_WORKERS processes, so the engine's one-per-core would oversubscribe
+API_ANOMALY_N_JOBS = int(os.environ.get('AUDIT_API_ANOMALY_JOBS', '1'))
+# when set, requests must send "Authorization: Bearer <token>"
+API_TOKEN = os.environ.get('AUDIT_API_TOKEN')
+
+RESULT_KINDS = ('deductions', 'anomalies')
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+app = Flask(__name__)
+
+
+# ------------------- Job storage -------------------
+def _job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+
+
+def read_status(job_id):
+    try:
+        with open(os.path.join(_job_dir(job_id), 'status.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_status(job_id, **fields):
+    status = read_status(job_id) or {'job_id': job_id}
+    status.update(fields)
+    path = os.path.join(_job_dir(job_id), 'status.json')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)  # readers never see a half-written status
+    return status
+
+
+# ------------------- Background workers -------------------
+def _init_worker(db_name):
+    # stage timings are logged as JSON lines on the 'dental_audit' logger
+    logging.basicConfig(level=os.environ.get('AUDIT_LOG_LEVEL', 'INFO'), format='%(asctime)s %(name)s %(message)s')
+    engine.ANOMALY_N_JOBS = API_ANOMALY_N_JOBS
+    # rules are loaded once per worker process
+    engine.shared_rules(db_name).get()
+    engine.shared_anomaly_model(db_name).get()
+
+
+def run_job(job_id, db_name):
+    """Run the deduction and anomaly stages for a stored upload (in a pool process)"""
+    job_dir = _job_dir(job_id)
+    write_status(job_id, status='running', started_at=_now())
+    trace = engine.AuditTrace(job_id=job_id)
+    try:
+        # the rules may have been changed by the app or another worker since the last job
+        rules = engine.shared_rules(db_name).refresh()
+        model = engine.shared_anomaly_model(db_name).refresh()
+        if rules.rules.empty:
+            raise ValueError('no rules have been uploaded')
+        with trace.activate():
+            with trace.stage('load_claims') as record:
+                data_df = engine.load_claims_cached(os.path.join(job_dir, 'claims.csv'))
+                record['rows'] = len(data_df)
+            with trace.stage('apply_deductions', len(data_df)):
+                deductions_df = engine.apply_deductions(data_df, plan=rules.plan)
+            with trace.stage('detect_fraud_with_isolation', len(data_df)):
+                anomaly_df = engine.detect_fraud_with_isolation(data_df, model=model)
+            engine.record_audit_cube(engine.path_digest(os.path.join(job_dir, 'claims.csv')), data_df,
+                                     deductions_df, anomaly_df, name=read_status(job_id).get('file_name'),
+                                     rules_version=rules.version, db_name=db_name)
+            with trace.stage('write_results', len(deductions_df) + len(anomaly_df)):
+                engine.write_csv(deductions_df, os.path.join(job_dir, 'deductions.csv'))
+                engine.write_csv(anomaly_df, os.path.join(job_dir, 'anomalies.csv'))
+    except Exception as e:
+        write_status(job_id, status='failed', error=str(e), finished_at=_now(), timings=trace.records)
+        return
+    write_status(job_id, status='done', finished_at=_now(), rows=len(data_df),
+                 deductions=len(deductions_df), anomalies=len(anomaly_df), timings=trace.records)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def job_pool():
+    """Process pool of this gunicorn worker, created after the fork on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=API_WORKERS, initializer=_init_worker, initargs=(engine.DB_NAME,))
+        return _pool
+
+
+def _discard_pool(pool):
+    """Drop a broken pool (e.g. a process was OOM-killed), so the next job gets a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _job_finished(job_id, pool, future):
+    """Mark the job failed if its process died or it never ran; run_job records its own errors"""
+    error = concurrent.futures.CancelledError() if future.cancelled() else future.exception()
+    if error is None:
+        return
+    write_status(job_id, status='failed', error=f'the worker process failed: {error!r}', finished_at=_now())
+    if isinstance(error, BrokenProcessPool):
+        _discard_pool(pool)
+
+
+def submit_to_pool(job_id):
+    """Queue run_job for job_id, replacing the pool once if it is already broken"""
+    for attempt in range(2):
+        pool = job_pool()
+        try:
+            future = pool.submit(run_job, job_id, engine.DB_NAME)
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            if attempt:
+                raise
+            continue
+        future.add_done_callback(functools.partial(_job_finished, job_id, pool))
+        return future
+
+
+# ------------------- HTTP endpoints -------------------
+@app.before_request
+def check_token():
+    if API_TOKEN and request.endpoint != 'health':
+        if request.headers.get('Authorization') != f'Bearer {API_TOKEN}':
+            abort(401)
+
+
+def _known_job(job_id):
+    status = read_status(job_id) if JOB_ID_PATTERN.match(job_id) else None
+    if status is None:
+        abort(404)
+    return status
+
+
+@app.get('/health')
+def health():
+    return jsonify(status='ok')
+
+
+@app.post('/jobs')
+def submit_job():
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify(error='send the claims CSV as the multipart field "file"'), 400
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(_job_dir(job_id))
+    upload.save(os.path.join(_job_dir(job_id), 'claims.csv'))
+    write_status(job_id, status='queued', file_name=upload.filename, submitted_at=_now())
+    submit_to_pool(job_id)
+    return jsonify(job_id=job_id, status='queued', status_url=f'/jobs/{job_id}'), 202
+
+
+@app.get('/jobs/<job_id>')
+def job_status(job_id):
+    return jsonify(_known_job(job_id))
+
+
+@app.get('/jobs/<job_id>/<kind>')
+def job_result(job_id, kind):
+    status = _known_job(job_id)
+    if kind not in RESULT_KINDS:
+        abort(404)
+    if status['status'] != 'done':
+        return jsonify(error=f"job is {status['status']}", status=status['status']), 409
+
+    path = os.path.join(_job_dir(job_id), f'{kind}.csv')
+    if request.args.get('format') == 'json':
+        try:
+            result_df = pd.read_csv(path, encoding='utf-8-sig')
+        except pd.errors.EmptyDataError:
+            result_df = pd.DataFrame()
+        return app.response_class(result_df.to_json(orient='records', force_ascii=False),
+                                  mimetype='application/json')
+    return send_file(os.path.abspath(path), mimetype='text/csv', as_attachment=True,
+                     download_name=f'{job_id}_{kind}.csv')
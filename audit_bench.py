@@ -0,0 +1,307 @@
+# audit_bench.py
+# Synthetic claims and benchmarks for the audit pipeline:
+#   python audit_bench.py --sizes 10k 1m 10m --out bench_results.json
+#   python audit_bench.py --sizes 10k --compare bench_results.json
+#   python audit_bench.py --write-claims claims.csv --write-rules rules.csv --sizes 50k
+#
+# Every run with the same --seed generates the same claims and rules, so results
+# written by different versions of the code can be compared stage by stage.
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+import audit_engine as engine
+
+
+DEFAULT_SIZES = ['10k', '1m', '10m']
+STAGES = ('extract_tooth_numbers', 'apply_deductions', 'detect_fraud_with_isolation', 'export_csv', 'export_excel')
+
+
+# ------------------- بيانات تجريبية -------------------
+# service -> (share of claims, price range, description templates); {t} is an FDI tooth code
+SERVICES = {
+    'IOE': (0.20, (80, 150), ['IOE', 'Intra oral examination']),
+    'XRD': (0.15, (60, 120), ['Periapical x-ray tooth {t}', 'XRD t{t}']),
+    'CL': (0.08, (150, 300), ['Scaling and polishing']),
+    'FIL': (0.22, (250, 700), ['Filling tooth {t}', 'Composite filling ({t})', 'GIC filling t-{t}']),
+    'EXT': (0.12, (200, 600), ['Extraction t {t}', 'Surgical extraction tooth {t}']),
+    'RCT': (0.10, (900, 2500), ['RCT {t}', 'Root canal treatment tooth {t}']),
+    'CRN': (0.05, (1500, 4000), ['crown ({t})', 'PFM crown tooth {t}']),
+    'PER': (0.08, (400, 1200), ['Gum surgery quadrant', 'Periodontal surgery']),
+}
+# mapped provider descriptions; the gum-surgery one triggers the quantity rule
+PROVIDER_DESCRIPTIONS = {
+    'PER': [engine.GUM_SURGERY_DESC + ' - قطاع', engine.GUM_SURGERY_DESC],
+    'FIL': ['حشو', 'حشو تجميلي'],
+    'EXT': ['خلع', 'خلع جراحي'],
+    'RCT': ['علاج عصب'],
+    'CRN': ['تركيب'],
+}
+PERMANENT_TEETH = [q * 10 + t for q in range(1, 5) for t in range(1, 9)]
+PRIMARY_TEETH = [q * 10 + t for q in range(5, 9) for t in range(1, 6)]
+TOOTH_SERVICES = ['XRD', 'FIL', 'EXT', 'RCT', 'CRN']
+
+
+def parse_size(value):
+    """'10k' / '1m' / '2500' -> number of rows"""
+    value = value.strip().lower()
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(value[-1:], 1)
+    number = value[:-1] if multiplier != 1 else value
+    try:
+        rows = int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid size: {value}')
+    if rows <= 0:
+        raise argparse.ArgumentTypeError(f'invalid size: {value}')
+    return rows
+
+
+def generate_rules(seed=0):
+    """
+    Rules table (with the rules CSV headers) for the tooth services: an age
+    range per service and tooth, primary teeth for children only.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for service in TOOTH_SERVICES:
+        for tooth in PERMANENT_TEETH:
+            rows.append((service, tooth, int(rng.choice([6, 12, 16])), None if rng.random() < 0.7 else 70))
+        for tooth in PRIMARY_TEETH:
+            rows.append((service, tooth, 0, int(rng.choice([10, 12, 13]))))
+    return pd.DataFrame(rows, columns=['SERV CAT', 'TOOTH_NUMBER', 'MIN_PATIENT_AGE', 'MAX_PATIENT_AGE'])
+
+
+def generate_claims(rows, seed=0, adherents=None, days=365):
+    """
+    Claims frame with the columns the app and load_claims produce, sorted by
+    nothing in particular (like real exports). Roughly one adherent per ten
+    claims, so repeated IOE visits and gum surgeries occur at realistic rates.
+    """
+    rng = np.random.default_rng(seed)
+    adherents = adherents or max(1, rows // 10)
+    services = list(SERVICES)
+    shares = np.array([SERVICES[s][0] for s in services])
+    service_codes = rng.choice(len(services), rows, p=shares / shares.sum())
+
+    adherent = rng.integers(0, adherents, rows)
+    # age is a property of the adherent
+    adherent_age = np.random.default_rng(seed + 1).integers(2, 85, adherents)
+    age = adherent_age[adherent].astype('float32')
+    age[rng.random(rows) < 0.01] = np.nan
+
+    # descriptions: every template of every service with children's teeth for the
+    # young and permanent teeth for the rest
+    templates = [(i, template) for i, s in enumerate(services) for template in SERVICES[s][2]]
+    descriptions, description_service, description_primary = [], [], []
+    for i, template in templates:
+        if '{t}' not in template:
+            descriptions.append(template)
+            description_service.append(i)
+            description_primary.append(None)
+            continue
+        for primary, teeth in ((False, PERMANENT_TEETH), (True, PRIMARY_TEETH)):
+            for tooth in teeth:
+                descriptions.append(template.format(t=tooth))
+                description_service.append(i)
+                description_primary.append(primary)
+    description_service = np.array(description_service)
+    description_primary = np.array(description_primary, dtype=object)
+
+    child = np.nan_to_num(age, nan=30) < 12
+    description_codes = np.empty(rows, dtype=np.int64)
+    for i in range(len(services)):
+        for is_child in (False, True):
+            selected = np.flatnonzero((service_codes == i) & (child == is_child))
+            if not len(selected):
+                continue
+            candidates = np.flatnonzero((description_service == i) &
+                                        np.array([p is None or p == is_child for p in description_primary]))
+            description_codes[selected] = rng.choice(candidates, len(selected))
+    # a few adults get children's codes and the other way round, for the age rule
+    flipped = rng.random(rows) < 0.02
+    tooth_descriptions = np.flatnonzero(description_primary != None)  # noqa: E711
+    description_codes[flipped] = rng.choice(tooth_descriptions, flipped.sum())
+
+    provider_descriptions = [d for s in services for d in PROVIDER_DESCRIPTIONS.get(s, [s])]
+    provider_codes = np.empty(rows, dtype=np.int64)
+    for i, service in enumerate(services):
+        selected = np.flatnonzero(service_codes == i)
+        options = [provider_descriptions.index(d) for d in PROVIDER_DESCRIPTIONS.get(service, [service])]
+        provider_codes[selected] = rng.choice(options, len(selected))
+
+    low = np.array([SERVICES[s][1][0] for s in services])[service_codes]
+    high = np.array([SERVICES[s][1][1] for s in services])[service_codes]
+    claimed = np.round(rng.uniform(low, high), 2)
+    outliers = rng.random(rows) < 0.005
+    claimed[outliers] *= rng.uniform(3, 10, outliers.sum())
+
+    dates = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, days * 24, rows), unit='h')
+    dates = dates.floor('D').to_numpy().copy()
+    dates[rng.random(rows) < 0.002] = np.datetime64('NaT')
+
+    return pd.DataFrame({
+        'SSNBR': pd.Categorical.from_codes(rng.integers(0, 2_000, rows),
+                                           categories=[str(1_000 + i) for i in range(2_000)]),
+        'ADHERENT#': pd.Categorical.from_codes(adherent, categories=[str(100_000 + i) for i in range(adherents)]),
+        'SERVICE': pd.Categorical.from_codes(service_codes, categories=services),
+        'GM ITEM DESCRIPTION': pd.Categorical.from_codes(description_codes, categories=descriptions),
+        'PROV ITEM DESC MAPPING': pd.Categorical.from_codes(provider_codes, categories=provider_descriptions),
+        'TRX DATE': dates,
+        'AGE': age,
+        'PROV NET CLAIMED': claimed,
+        'QTYAPP': rng.choice(np.array([1, 1, 1, 1, 2, 3], dtype='float32'), rows),
+    })
+
+
+# ------------------- القياس -------------------
+def measure(stage, rows, func, *args, **kwargs):
+    """Run func(*args, **kwargs) once; returns (result, record)"""
+    with engine.PeakMemory() as memory:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    record = {
+        'stage': stage,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(rows / seconds) if seconds > 0 else None,
+        'peak_mb': round(memory.peak / 1e6, 1) if memory.peak is not None else None,
+    }
+    return result, record
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, seed=0, stages=STAGES):
+    """Benchmark records for every size and stage (each stage runs once per size)"""
+    age_index = engine.AgeRuleIndex.from_rules(
+        generate_rules(seed).rename(columns=engine.RULES_CSV_COLUMNS))
+    plan = engine.compile_deduction_rules(engine.DEFAULT_DEDUCTION_RULES, age_index)
+    records = []
+    for rows in sizes:
+        claims = generate_claims(rows, seed)
+        if 'extract_tooth_numbers' in stages:
+            engine._extract_tooth_code.cache_clear()
+            tooth, record = measure('extract_tooth_numbers', rows,
+                                    engine.extract_tooth_numbers, claims['GM ITEM DESCRIPTION'])
+            records.append(record)
+        claims['EXTRACTED_TOOTH'] = engine.extract_tooth_numbers(claims['GM ITEM DESCRIPTION'])
+
+        deductions_df = None
+        if 'apply_deductions' in stages or 'export_csv' in stages or 'export_excel' in stages:
+            deductions_df, record = measure('apply_deductions', rows, engine.apply_deductions, claims, plan=plan)
+            if 'apply_deductions' in stages:
+                records.append(record)
+        if 'detect_fraud_with_isolation' in stages:
+            _, record = measure('detect_fraud_with_isolation', rows, engine.detect_fraud_with_isolation, claims)
+            records.append(record)
+
+        # the exports are of the deductions table, as rendered by the app
+        if 'export_csv' in stages:
+            _, record = measure('export_csv', len(deductions_df), engine.write_csv, deductions_df, io.BytesIO())
+            records.append(dict(record, claims_rows=rows))
+        if 'export_excel' in stages:
+            if len(deductions_df) < engine.EXCEL_MAX_ROWS:
+                _, record = measure('export_excel', len(deductions_df),
+                                    engine.write_excel, io.BytesIO(), [('deductions', deductions_df)])
+                records.append(dict(record, claims_rows=rows))
+            else:
+                records.append({'stage': 'export_excel', 'rows': len(deductions_df), 'claims_rows': rows,
+                                'skipped': 'more rows than an Excel sheet can hold'})
+        del claims, deductions_df
+    return records
+
+
+def environment():
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(records, baseline):
+    """Lines comparing records with the records of an earlier run"""
+    earlier = {(r['stage'], r['rows']): r for r in baseline.get('results', []) if 'seconds' in r}
+    lines = []
+    for record in records:
+        before = earlier.get((record['stage'], record['rows']))
+        if before is None or 'seconds' not in record:
+            continue
+        ratio = record['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        lines.append(f"{record['stage']:<28} {record['rows']:>10}  {before['seconds']:>9.3f}s -> "
+                     f"{record['seconds']:>9.3f}s  x{ratio:.2f}")
+    return lines
+
+
+def format_record(record):
+    if 'skipped' in record:
+        return f"{record['stage']:<28} {record['rows']:>10}  skipped: {record['skipped']}"
+    peak = f"{record['peak_mb']:>8.1f} MB" if record['peak_mb'] is not None else '       n/a'
+    return (f"{record['stage']:<28} {record['rows']:>10}  {record['seconds']:>9.3f}s  "
+            f"{record['rows_per_second'] or 0:>12,} rows/s  {peak}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the audit pipeline on seeded synthetic claims.')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[parse_size(s) for s in DEFAULT_SIZES],
+                        metavar='ROWS', help='claims rows per run, e.g. 10k 1m 10m (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='generator seed (default: 0)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help='stages to time')
+    parser.add_argument('--out', default='bench_results.json', help='results file (default: %(default)s)')
+    parser.add_argument('--compare', metavar='JSON', help='results of an earlier run to compare against')
+    parser.add_argument('--write-claims', metavar='CSV',
+                        help='only write the claims for the first size to CSV (e.g. to try the app)')
+    parser.add_argument('--write-rules', metavar='CSV', help='only write the matching rules CSV')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.write_claims or args.write_rules:
+        if args.write_rules:
+            generate_rules(args.seed).to_csv(args.write_rules, index=False, encoding='utf-8-sig')
+        if args.write_claims:
+            claims = generate_claims(args.sizes[0], args.seed)
+            claims['TRX DATE'] = pd.to_datetime(claims['TRX DATE']).dt.strftime('%Y-%m-%d')
+            engine.write_csv(claims, args.write_claims)
+        return 0
+
+    records = []
+    for rows in args.sizes:
+        # one size at a time so results are printed as they come
+        for record in run_benchmarks([rows], args.seed, args.stages):
+            print(format_record(record), flush=True)
+            records.append(record)
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'seed': args.seed, 'results': records}, f, indent=2)
+    print(f'results written to {args.out}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            lines = compare(records, json.load(f))
+        print('\n'.join(lines) if lines else 'nothing to compare')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
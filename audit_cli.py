@@ -0,0 +1,198 @@
+# audit_cli.py
+# Headless batch audits, without Streamlit:
+#   python audit_cli.py claims/*.csv --db dental_rules.db --out results --format parquet
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import pandas as pd
+
+import audit_engine as engine
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def max_samples(value):
+    """IsolationForest max_samples: 'auto', a row count, or a fraction of the rows"""
+    if value == 'auto':
+        return value
+    number = float(value)
+    if number <= 0 or (number > 1 and not number.is_integer()):
+        raise argparse.ArgumentTypeError(f'invalid sample size: {value}')
+    return number if number <= 1 and '.' in value else int(number)
+
+
+def fit_options(args):
+    return {'n_estimators': args.anomaly_trees, 'max_samples': args.anomaly_max_samples,
+            'fit_rows': args.anomaly_fit_rows}
+
+
+def write_frame(df, path, fmt):
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        # utf-8-sig so Excel shows the Arabic descriptions correctly
+        df.to_csv(path, index=False, encoding='utf-8-sig')
+
+
+def audit_file(path, args, rules, model=None):
+    """Audit one claims file and write its outputs; returns (timings, counts)"""
+    timings = {}
+    data_df = None
+    period_id = state = None
+    if args.incremental:
+        period_id = engine.path_digest(path)
+        if engine.is_period_committed(period_id, args.db):
+            raise ValueError('already audited incrementally')
+    if args.chunksize:
+        with timed(timings, 'deductions'):
+            if args.incremental:
+                state = engine.load_deduction_state(db_name=args.db)
+            deductions_df = engine.apply_deductions_streaming(path, chunksize=args.chunksize,
+                                                              plan=rules.plan, state=state)
+    if not (args.chunksize and args.skip_anomalies):
+        with timed(timings, 'load'):
+            if args.claims_cache:
+                data_df = engine.load_claims_cached(path, cache_dir=args.claims_cache)
+            else:
+                data_df = engine.load_claims(path)
+    if not args.chunksize:
+        with timed(timings, 'deductions'):
+            if args.incremental:
+                data_df, state = engine.load_period_state(data_df, period_id, os.path.basename(path), args.db)
+                deductions_df = engine.apply_deductions(data_df, plan=rules.plan, state=state)
+            elif args.workers > 1:
+                deductions_df = engine.apply_deductions_parallel(data_df, workers=args.workers, plan=rules.plan)
+            else:
+                deductions_df = engine.apply_deductions(data_df, plan=rules.plan)
+    anomaly_df = None
+    if not args.skip_anomalies:
+        with timed(timings, 'anomalies'):
+            anomaly_df = engine.detect_fraud_with_isolation(data_df, model=model, **fit_options(args))
+
+    if data_df is not None:
+        # totals for the app's dashboard
+        with timed(timings, 'cube'):
+            digest = period_id or engine.path_digest(path)
+            engine.record_audit_cube(digest, data_df, deductions_df, anomaly_df, name=os.path.basename(path),
+                                     rules_version=rules.version, db_name=args.db)
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    with timed(timings, 'write'):
+        if args.report:
+            result = engine.AuditResult(deductions_df, anomaly_df if anomaly_df is not None else pd.DataFrame(), None)
+            extension = 'xlsx' if args.report == 'xlsx' else 'zip'
+            engine.write_report(os.path.join(args.out, f'{stem}_report.{extension}'), result, args.report)
+        else:
+            write_frame(deductions_df, os.path.join(args.out, f'{stem}_deductions.{args.format}'), args.format)
+            if anomaly_df is not None:
+                write_frame(anomaly_df, os.path.join(args.out, f'{stem}_anomalies.{args.format}'), args.format)
+
+    if state is not None:
+        # only once every output is written, so a failed run can be re-run
+        with timed(timings, 'commit'):
+            engine.commit_deduction_state(state, period_id, name=os.path.basename(path),
+                                          claims=len(data_df) if data_df is not None else None, db_name=args.db)
+
+    counts = {
+        'rows': len(data_df) if data_df is not None else None,
+        'deductions': len(deductions_df),
+        'anomalies': len(anomaly_df) if anomaly_df is not None else None,
+    }
+    return timings, counts
+
+
+def format_report(path, timings, counts):
+    stages = ' | '.join(f'{stage} {seconds:.2f}s' for stage, seconds in timings.items())
+    totals = ', '.join(f'{value} {name}' for name, value in counts.items() if value is not None)
+    return f'{path}: {stages} | total {sum(timings.values()):.2f}s | {totals}'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run dental claim audits without the Streamlit UI.')
+    parser.add_argument('claims', nargs='+', help='claims CSV file(s) to audit')
+    parser.add_argument('--db', default=engine.DB_NAME, help='rules database (default: %(default)s)')
+    parser.add_argument('--out', default='.', help='output directory (default: current directory)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help='output format (default: csv)')
+    parser.add_argument('--report', choices=engine.REPORT_FORMATS,
+                        help='write one report bundle per file instead of separate outputs: an xlsx workbook, '
+                             'or a zip of csv/parquet files (summary, deductions and each risk level)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for the deduction stage, sharded by ADHERENT# (default: 1)')
+    parser.add_argument('--chunksize', type=int, default=0,
+                        help='stream deductions over chunks of this many rows instead of loading the file whole')
+    parser.add_argument('--claims-cache', metavar='DIR',
+                        help='keep parsed claims as Parquet in DIR so re-audits of the same file skip CSV parsing')
+    parser.add_argument('--incremental', action='store_true',
+                        help='continue the deduction rules from the state of earlier periods saved in the rules '
+                             'database and save the new state; pass period files in date order')
+    parser.add_argument('--train-anomaly-model', metavar='CSV',
+                        help='fit the anomaly model on this baseline file and store it in the rules database; '
+                             'claims are then scored against the stored model')
+    parser.add_argument('--anomaly-trees', type=int, metavar='N',
+                        help=f'IsolationForest trees (default: {engine.ANOMALY_N_ESTIMATORS})')
+    parser.add_argument('--anomaly-max-samples', type=max_samples, metavar='N',
+                        help=f'claims drawn for each tree: a count, a fraction such as 0.1, or auto '
+                             f'(default: {engine.ANOMALY_MAX_SAMPLES})')
+    parser.add_argument('--anomaly-fit-rows', type=int, metavar='N',
+                        help=f'fit the anomaly model on a seeded sample of at most N claims '
+                             f'(default: {engine.ANOMALY_FIT_MAX_ROWS})')
+    parser.add_argument('--skip-anomalies', action='store_true', help='only run the deduction stage')
+    args = parser.parse_args(argv)
+    if args.incremental and args.workers > 1:
+        parser.error('--incremental cannot be combined with --workers')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.db):
+        print(f'error: rules database not found: {args.db}', file=sys.stderr)
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+
+    # rules are loaded once for the whole batch
+    start = time.perf_counter()
+    rules = engine.shared_rules(args.db).get()
+    if rules.rules.empty:
+        print(f'error: no rules have been uploaded to {args.db}', file=sys.stderr)
+        return 2
+    print(f'rules: {len(rules.rules)} rules, {len(rules.plan)} deduction rules (version {rules.version}) '
+          f'loaded in {time.perf_counter() - start:.2f}s')
+
+    models = engine.shared_anomaly_model(args.db)
+    if args.train_anomaly_model:
+        start = time.perf_counter()
+        model = models.train(engine.load_claims(args.train_anomaly_model),
+                             trained_on=os.path.basename(args.train_anomaly_model), **fit_options(args))
+        print(f'anomaly model {model.model_id} trained on {model.claims} claims in {time.perf_counter() - start:.2f}s')
+    model = models.get()
+    if models.unusable:
+        print('warning: the stored anomaly model cannot be used (see above); each file is scored on its own '
+              'until it is retrained with --train-anomaly-model', file=sys.stderr)
+
+    failed = 0
+    for path in args.claims:
+        try:
+            timings, counts = audit_file(path, args, rules, model)
+        except Exception as e:
+            failed += 1
+            print(f'{path}: failed: {e}', file=sys.stderr)
+            continue
+        print(format_report(path, timings, counts))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
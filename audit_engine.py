@@ -0,0 +1,2285 @@
+# audit_engine.py
+# Audit logic without any Streamlit dependency: shared by the app (dental_audit.py)
+# and the headless tools.
+import pandas as pd
+import sqlite3
+import hashlib
+import functools
+import collections
+import threading
+import os
+import importlib.util
+import contextlib
+import contextvars
+import concurrent.futures
+import logging
+import time
+import io
+import re
+import zipfile
+import pickle
+import json
+import tempfile
+import numpy as np
+import joblib
+import sklearn
+import xlsxwriter
+from sklearn.preprocessing import StandardScaler
+from sklearn.ensemble import IsolationForest
+
+# ------------------- إعداد قاعدة البيانات -------------------
+DB_NAME = "dental_rules.db"
+
+# number of audited files whose results are kept in memory across reruns
+AUDIT_CACHE_SIZE = 8
+# generated download files (CSV/XLSX of result tables) kept in memory by the app
+EXPORT_CACHE_SIZE = 16
+# rows per chunk when claims files are streamed instead of loaded whole
+CLAIMS_CHUNK_ROWS = 200_000
+# worker processes for apply_deductions_parallel, and the size below which it stays serial
+DEDUCTION_WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_ROWS = 100_000
+# normalised claims files kept as Parquet, keyed by the sha256 of the uploaded file;
+# bump CLAIMS_CACHE_FORMAT whenever normalize_claims changes its output
+CLAIMS_CACHE_DIR = "claims_cache"
+CLAIMS_CACHE_FORMAT = 4
+CLAIMS_CACHE_MAX_FILES = 50
+# trained anomaly models kept in the anomaly_models table (the newest one is used)
+ANOMALY_MODELS_KEPT = 5
+# IsolationForest settings. Files with more than ANOMALY_FIT_MAX_ROWS scored claims are
+# fitted on a seeded sample of that size; scoring runs in chunks of ANOMALY_SCORE_CHUNK_ROWS.
+# Results do not depend on ANOMALY_N_JOBS.
+ANOMALY_N_ESTIMATORS = 100
+ANOMALY_MAX_SAMPLES = 'auto'
+ANOMALY_FIT_MAX_ROWS = 1_000_000
+ANOMALY_SCORE_CHUNK_ROWS = 200_000
+ANOMALY_N_JOBS = os.cpu_count() or 1
+ANOMALY_RANDOM_STATE = 42
+
+# rules CSV headers -> columns of the rules table
+RULES_CSV_COLUMNS = {
+    'SERV CAT': 'serv_cat',
+    'TOOTH_NUMBER': 'tooth_number',
+    'MIN_PATIENT_AGE': 'min_patient_age',
+    'MAX_PATIENT_AGE': 'max_patient_age',
+    'New CPT': 'new_cpt',
+    'Arabic Description': 'arabic_desc',
+    'English Description': 'english_desc',
+    'SERVICE_CODE': 'service_code',
+    'TOOTH_TYPE': 'tooth_type',
+    'TOOTH_CATEGORY': 'tooth_category',
+    'SERVICE_CATEGORY': 'service_category',
+    'Service type': 'service_type',
+}
+RULES_COLUMNS = list(RULES_CSV_COLUMNS.values())
+REQUIRED_RULES_COLUMNS = ['serv_cat', 'tooth_number', 'min_patient_age', 'max_patient_age']
+# columns of the deduction_rules table (payer rules compiled by compile_deduction_rules)
+DEDUCTION_RULE_COLUMNS = ['rule_id', 'kind', 'service', 'description', 'window_days', 'max_quantity',
+                          'period', 'tooth_from', 'tooth_to', 'min_age', 'max_age', 'reason', 'enabled']
+
+_connections = threading.local()
+
+def get_connection(db_name=None):
+    """
+    Persistent connection for this thread (and process), in WAL mode so that
+    rule uploads never block readers.
+    """
+    db_name = db_name or DB_NAME
+    cache = getattr(_connections, 'by_db', None)
+    if cache is None or _connections.pid != os.getpid():
+        # connections must not be shared with forked worker processes
+        cache = _connections.by_db = {}
+        _connections.pid = os.getpid()
+    conn = cache.get(db_name)
+    if conn is None:
+        conn = sqlite3.connect(db_name, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        cache[db_name] = conn
+    return conn
+
+RULES_SCHEMA = '''(serv_cat text, tooth_number integer,
+                  min_patient_age integer, max_patient_age integer,
+                  new_cpt text, arabic_desc text, english_desc text,
+                  service_code text, tooth_type text, tooth_category text,
+                  service_category text, service_type text)'''
+
+DEDUCTION_RULES_SCHEMA = '''(rule_id text PRIMARY KEY, kind text NOT NULL,
+                            service text, description text, window_days integer, max_quantity integer,
+                            period text, tooth_from integer, tooth_to integer,
+                            min_age integer, max_age integer, reason text,
+                            enabled integer NOT NULL DEFAULT 1)'''
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def _migrate_rules_table(conn):
+    """Rebuild a rules table written by older versions (to_sql replace) with the fixed schema"""
+    existing = [row[1] for row in conn.execute("PRAGMA table_info(rules)")]
+    if not existing or existing == RULES_COLUMNS:
+        return
+    common = ', '.join(f'"{c}"' for c in RULES_COLUMNS if c in existing)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(f"CREATE TABLE rules_migrated {RULES_SCHEMA}")
+        if common:
+            conn.execute(f"INSERT INTO rules_migrated ({common}) SELECT {common} FROM rules")
+        conn.execute("DROP TABLE rules")
+        conn.execute("ALTER TABLE rules_migrated RENAME TO rules")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _migrate_adherent_state(conn):
+    """Move the IOE / gum-surgery state saved by older versions into rule_state"""
+    if not _table_exists(conn, 'adherent_state'):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if _table_exists(conn, 'adherent_state'):
+            conn.execute('''INSERT OR IGNORE INTO rule_state (rule_id, adherent, period, last_date)
+                            SELECT 'ioe_repeat', adherent, '', ioe_last_date FROM adherent_state
+                            WHERE ioe_last_date IS NOT NULL''')
+            conn.execute('''INSERT OR IGNORE INTO rule_state (rule_id, adherent, period, quantity)
+                            SELECT 'gum_surgery', adherent, '', gum_total_qty FROM adherent_state
+                            WHERE gum_total_qty IS NOT NULL''')
+            conn.execute("DROP TABLE adherent_state")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def init_db(db_name=None):
+    conn = get_connection(db_name)
+    _migrate_rules_table(conn)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS rules {RULES_SCHEMA}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rules_serv_tooth ON rules (serv_cat, tooth_number)")
+    # bumped by every write to the rules table
+    conn.execute("CREATE TABLE IF NOT EXISTS rules_meta (version integer NOT NULL)")
+    conn.execute("INSERT INTO rules_meta (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM rules_meta)")
+    # payer deduction rules; a new table starts with the built-in rules
+    if not _table_exists(conn, 'deduction_rules'):
+        conn.execute(f"CREATE TABLE IF NOT EXISTS deduction_rules {DEDUCTION_RULES_SCHEMA}")
+        _write_deduction_rules(conn, deduction_rule_rows(DEFAULT_DEDUCTION_RULES))
+    # per-adherent state of each deduction rule carried between incremental audit periods
+    # (period is '' unless the rule keeps state per calendar period or claim key)
+    # (period is the SERVICE, and events a JSON list of [day, quantity], for frequency_limit rules)
+    conn.execute('''CREATE TABLE IF NOT EXISTS rule_state
+                 (rule_id text, adherent text, period text, last_date text, quantity integer, events text,
+                  PRIMARY KEY (rule_id, adherent, period))''')
+    if 'events' not in [row[1] for row in conn.execute("PRAGMA table_info(rule_state)")]:
+        conn.execute("ALTER TABLE rule_state ADD COLUMN events text")
+    _migrate_adherent_state(conn)
+    conn.execute('''CREATE TABLE IF NOT EXISTS audit_periods
+                 (period_id text PRIMARY KEY, name text, claims integer, committed_at text)''')
+    # dashboard cube: per audited file, totals by provider, service and month
+    conn.execute('''CREATE TABLE IF NOT EXISTS audit_cube
+                 (file text, provider text, service text, month text,
+                  claims integer, claimed real, deductions integer, deducted real, anomalies integer,
+                  PRIMARY KEY (file, provider, service, month))''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_cube_month ON audit_cube (month)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS audit_files
+                 (file text PRIMARY KEY, name text, audited_at text, rules_version integer, claims integer)''')
+    # baseline anomaly models: pickled scaler + forest with the feature list they were fitted on
+    conn.execute('''CREATE TABLE IF NOT EXISTS anomaly_models
+                 (model_id integer PRIMARY KEY AUTOINCREMENT, trained_at text, trained_on text,
+                  claims integer, features text, sklearn_version text, model blob)''')
+
+def _write_rules(conn, rows):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM rules")
+        if rows is not None:
+            placeholders = ', '.join('?' * len(RULES_COLUMNS))
+            conn.executemany(f"INSERT INTO rules ({', '.join(RULES_COLUMNS)}) VALUES ({placeholders})", rows)
+        conn.execute("UPDATE rules_meta SET version = version + 1")
+        version = conn.execute("SELECT version FROM rules_meta").fetchone()[0]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return version
+
+def replace_rules(rules_df, db_name=None):
+    """
+    Atomically replace the stored rules with rules_df (CSV headers or table
+    column names). Readers keep seeing the previous rules until the commit.
+
+    Returns the new rules version.
+    """
+    rules_df = rules_df.rename(columns=RULES_CSV_COLUMNS)
+    missing = [c for c in REQUIRED_RULES_COLUMNS if c not in rules_df.columns]
+    if missing:
+        raise ValueError(f"missing rules columns: {', '.join(missing)}")
+    rules_df = rules_df.reindex(columns=RULES_COLUMNS).astype(object)
+    rules_df = rules_df.where(rules_df.notna(), None)
+
+    init_db(db_name)
+    return _write_rules(get_connection(db_name), rules_df.itertuples(index=False, name=None))
+
+def delete_rules(db_name=None):
+    """Remove all rules; returns the new rules version"""
+    init_db(db_name)
+    return _write_rules(get_connection(db_name), None)
+
+def load_rules(db_name=None):
+    """Read the rules table (empty DataFrame if it does not exist yet)"""
+    try:
+        return pd.read_sql("SELECT * FROM rules", get_connection(db_name))
+    except Exception:
+        return pd.DataFrame()
+
+def _write_deduction_rules(conn, rule_rows):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM deduction_rules")
+        placeholders = ', '.join('?' * len(DEDUCTION_RULE_COLUMNS))
+        conn.executemany(
+            f"INSERT INTO deduction_rules ({', '.join(DEDUCTION_RULE_COLUMNS)}) VALUES ({placeholders})",
+            (rule[:-1] + (int(enabled),) for rule, enabled in rule_rows))
+        conn.execute("UPDATE rules_meta SET version = version + 1")
+        version = conn.execute("SELECT version FROM rules_meta").fetchone()[0]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return version
+
+def replace_deduction_rules(rules_df, db_name=None):
+    """
+    Validate and atomically replace the stored deduction rules with rules_df
+    (DEDUCTION_RULE_COLUMNS, headers in any case); rows are evaluated and
+    reported in order. Raises ValueError naming the first invalid rule.
+
+    Returns the new rules version.
+    """
+    rules_df = rules_df.rename(columns=lambda c: str(c).strip().lower())
+    missing = [c for c in ('rule_id', 'kind') if c not in rules_df.columns]
+    if missing:
+        raise ValueError(f"missing deduction rules columns: {', '.join(missing)}")
+    rule_rows = deduction_rule_rows(rules_df)
+
+    init_db(db_name)
+    return _write_deduction_rules(get_connection(db_name), rule_rows)
+
+def load_deduction_rules(db_name=None):
+    """Read the deduction_rules table in order (the built-in rules before init_db)"""
+    try:
+        return pd.read_sql(f"SELECT {', '.join(DEDUCTION_RULE_COLUMNS)} FROM deduction_rules ORDER BY rowid",
+                           get_connection(db_name))
+    except Exception:
+        return DEFAULT_DEDUCTION_RULES.copy()
+
+def rules_version(db_name=None):
+    """Counter bumped by every rules or deduction rules write (None before init_db)"""
+    try:
+        return get_connection(db_name).execute("SELECT version FROM rules_meta").fetchone()[0]
+    except (sqlite3.OperationalError, TypeError):
+        return None
+
+# ------------------- نسخة القواعد المشتركة في الذاكرة -------------------
+RulesSnapshot = collections.namedtuple('RulesSnapshot', ['version', 'rules', 'age_index', 'deduction_rules', 'plan'])
+
+class RulesRegistry:
+    """
+    Immutable in-memory snapshot of the rules and deduction_rules tables,
+    with the deduction plan compiled from them, shared by every session of
+    the process.
+
+    Readers take get() without touching the database; the snapshot is only
+    rebuilt by replace()/delete() (or refresh() when another process may
+    have written the rules). Treat snapshot.rules as read-only.
+    """
+
+    def __init__(self, db_name=None):
+        self.db_name = db_name
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+                snapshot = self._snapshot
+        return snapshot
+
+    def _load(self):
+        version = rules_version(self.db_name)
+        rules_df = load_rules(self.db_name)
+        age_index = AgeRuleIndex.from_rules(rules_df)
+        deduction_rules = load_deduction_rules(self.db_name)
+        return RulesSnapshot(version, rules_df, age_index, deduction_rules,
+                             compile_deduction_rules(deduction_rules, age_index))
+
+    def reload(self):
+        with self._lock:
+            self._snapshot = self._load()
+            return self._snapshot
+
+    def refresh(self):
+        """Reload only if the stored version moved (written by another process)"""
+        snapshot = self.get()
+        if rules_version(self.db_name) != snapshot.version:
+            snapshot = self.reload()
+        return snapshot
+
+    def replace(self, rules_df):
+        replace_rules(rules_df, self.db_name)
+        return self.reload()
+
+    def delete(self):
+        delete_rules(self.db_name)
+        return self.reload()
+
+    def replace_deduction_rules(self, rules_df):
+        replace_deduction_rules(rules_df, self.db_name)
+        return self.reload()
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+def shared_rules(db_name=None):
+    """The process-wide RulesRegistry for db_name"""
+    db_name = db_name or DB_NAME
+    with _registries_lock:
+        if db_name not in _registries:
+            _registries[db_name] = RulesRegistry(db_name)
+        return _registries[db_name]
+
+# ------------------- قياس مراحل التدقيق -------------------
+log = logging.getLogger('dental_audit')
+
+def rss_bytes():
+    """Resident memory of this process (Linux), or None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class PeakMemory:
+    """Highest resident memory above the starting point, sampled on a background thread"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+
+    def __enter__(self):
+        self._start = rss_bytes()
+        self._highest = self._start
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            rss = rss_bytes()
+            if rss is not None and rss > self._highest:
+                self._highest = rss
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        if self._start is not None:
+            self.peak = max(self._highest, rss_bytes() or 0) - self._start
+
+_active_trace = contextvars.ContextVar('audit_trace', default=None)
+
+class AuditTrace:
+    """
+    Wall time, rows and peak memory of each pipeline stage of one audit.
+    Every finished stage is also logged to the 'dental_audit' logger as a
+    JSON line, with the trace's context fields (file digest, job id, ...).
+    """
+
+    def __init__(self, **context):
+        self.context = context
+        self.records = []
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make stage() calls in this thread record into this trace"""
+        token = _active_trace.set(self)
+        try:
+            yield self
+        finally:
+            _active_trace.reset(token)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        """Time a stage; rows may also be set on the yielded record once known"""
+        record = {'stage': name, 'depth': self._depth, 'rows': rows}
+        self.records.append(record)
+        self._depth += 1
+        failed = True
+        memory = PeakMemory()
+        start = time.perf_counter()
+        try:
+            with memory:
+                yield record
+            failed = False
+        finally:
+            seconds = time.perf_counter() - start
+            self._depth -= 1
+            rows = record['rows']
+            record.update(
+                seconds=round(seconds, 4),
+                rows_per_second=round(rows / seconds) if rows and seconds > 0 else None,
+                peak_mb=round(memory.peak / 1e6, 1) if memory.peak is not None else None,
+            )
+            if failed:
+                record['failed'] = True
+            log.info(json.dumps({'event': 'audit_stage', **self.context, **record}, ensure_ascii=False, default=str))
+
+def stage(name, rows=None):
+    """AuditTrace.stage of the trace active in this thread; does nothing without one"""
+    trace = _active_trace.get()
+    if trace is None:
+        return contextlib.nullcontext({'stage': name, 'rows': rows})
+    return trace.stage(name, rows)
+
+# ------------------- استخراج رقم السن من الوصف -------------------
+# tried in order; the first valid FDI code found wins
+TOOTH_PATTERNS = [re.compile(p, re.IGNORECASE) for p in
+                  (r'tooth[\s\-_]?(\d+)', r't[\s\-_]?(\d+)', r'\b(\d{1,2})\b', r'\((\d{1,2})\)')]
+# FDI two-digit notation: permanent quadrants 1-4 (teeth 1-8), primary quadrants 5-8 (teeth 1-5)
+FDI_TOOTH_CODES = frozenset(
+    [q * 10 + t for q in range(1, 5) for t in range(1, 9)] +
+    [q * 10 + t for q in range(5, 9) for t in range(1, 6)]
+)
+
+@functools.lru_cache(maxsize=65536)
+def _extract_tooth_code(description):
+    for pattern in TOOTH_PATTERNS:
+        for match in pattern.finditer(description):
+            code = int(match.group(1))
+            if code in FDI_TOOTH_CODES:
+                return code
+    return None
+
+def extract_tooth_number(description):
+    """Extract an FDI tooth number from a claim description, or None"""
+    if description is None or pd.isna(description):
+        return None
+    return _extract_tooth_code(str(description))
+
+def extract_tooth_numbers(descriptions):
+    """
+    Extract tooth numbers for a whole description column.
+
+    The regexes run once per distinct description and the result is mapped
+    back onto every row (float, NaN where no tooth was found).
+    """
+    if descriptions is None:
+        return np.nan
+    codes, uniques = pd.factorize(descriptions, sort=False)
+    extracted = np.array([extract_tooth_number(d) for d in uniques], dtype=float)
+    extracted = np.append(extracted, np.nan)  # factorize marks missing values as -1
+    return pd.Series(extracted[codes], index=descriptions.index)
+
+# ------------------- دوال تطبيق الخصومات وكشف الشذوذ (من كودك الأصلي) -------------------
+IOE_REPEAT_DAYS = 30
+GUM_SURGERY_DESC = 'جراحة اللثة الصديدية'
+GUM_SURGERY_MAX_QTY = 2
+# claims repeating an earlier one (adherent, service, tooth, amount) up to this many days later
+DUPLICATE_WINDOW_DAYS = 3
+
+# seeded into a new deduction_rules table: the original IOE, gum-surgery and age checks
+# and duplicate claims
+DEFAULT_DEDUCTION_RULES = pd.DataFrame([
+    {'rule_id': 'ioe_repeat', 'kind': 'repeat_within_days', 'service': 'IOE',
+     'window_days': IOE_REPEAT_DAYS, 'reason': 'Follow-up'},
+    {'rule_id': 'gum_surgery', 'kind': 'quantity_cap', 'description': GUM_SURGERY_DESC,
+     'max_quantity': GUM_SURGERY_MAX_QTY,
+     'reason': 'تجاوز حد جراحة اللثة (الحد الأقصى {max_quantity}، الكمية الإجمالية {total_quantity})'},
+    {'rule_id': 'age_mismatch', 'kind': 'age_tooth_bounds', 'reason': 'incompatible age'},
+    {'rule_id': 'duplicate_claims', 'kind': 'duplicate_claims', 'window_days': DUPLICATE_WINDOW_DAYS,
+     'reason': 'Duplicate claim ({days_apart} days apart)'},
+], columns=DEDUCTION_RULE_COLUMNS)
+
+# quantity_cap periods -> strftime bucket of TRX_DATE (claims without a date share one bucket)
+RULE_PERIODS = {'year': '%Y', 'month': '%Y-%m'}
+
+# kind -> (output columns in report order, default REASON, evaluator(claims, rule, state)).
+# Evaluators get the prepared claims selected by the rule's service / description and
+# return the flagged ones; REASON templates may use any DeductionRule field in braces.
+DEDUCTION_RULE_KINDS = {}
+
+def deduction_rule_kind(kind, columns, reason):
+    def register(evaluator):
+        DEDUCTION_RULE_KINDS[kind] = (columns, reason, evaluator)
+        return evaluator
+    return register
+
+# a validated deduction_rules row; age_index is set for age bounds read from the rules table
+DeductionRule = collections.namedtuple('DeductionRule', DEDUCTION_RULE_COLUMNS[:-1] + ['age_index'])
+
+def _reason(rule, **values):
+    return rule.reason.format(**rule._asdict(), **values)
+
+def _claim_column(claims, name, default):
+    if name in claims.columns:
+        return claims[name]
+    return pd.Series(default, index=claims.index, dtype=object)
+
+def prepare_claims(data_df, rows=None):
+    """
+    Sort claims by date and derive the typed columns used by the deduction rules.
+
+    Returns a frame indexed 0, 1, ... so that every rule can refer to a claim
+    by its position in date order. rows: file row number of each claim, used
+    as the index instead when only part of a file is prepared at a time.
+    """
+    if rows is not None:
+        data_df = data_df.set_axis(np.asarray(rows))
+    if 'TRX DATE' in data_df.columns:
+        data_df = data_df.sort_values('TRX DATE', kind='mergesort')
+    claims = data_df.reset_index(drop=True) if rows is None else data_df
+    # PROVIDER is optional, and only reported when the file has it
+    provider = {'PROVIDER': claims['PROVIDER']} if 'PROVIDER' in claims.columns else {}
+
+    trx_date = _claim_column(claims, 'TRX DATE', None)
+    if not pd.api.types.is_datetime64_any_dtype(trx_date):
+        trx_date = pd.to_datetime(trx_date, errors='coerce')
+    qty = pd.to_numeric(_claim_column(claims, 'QTYAPP', np.nan), errors='coerce')
+    quantity = qty.where(qty.notna() & (qty != 0), 1).astype('int64')
+
+    return pd.DataFrame({
+        'SSNBR': _claim_column(claims, 'SSNBR', ''),
+        **provider,
+        'ADHERENT#': _claim_column(claims, 'ADHERENT#', ''),
+        'SERVICE': _claim_column(claims, 'SERVICE', ''),
+        'GM_ITEM_DESCRIPTION': _claim_column(claims, 'GM ITEM DESCRIPTION', ''),
+        'PROV_ITEM_DESC': _claim_column(claims, 'PROV ITEM DESC MAPPING', '').astype(str),
+        'TOOTH_NUMBER': _claim_column(claims, 'EXTRACTED_TOOTH', np.nan),
+        'PATIENT_AGE': pd.to_numeric(_claim_column(claims, 'AGE', np.nan), errors='coerce').fillna(0).astype('int64'),
+        'TRX_DATE': trx_date,
+        'TRX DATE': trx_date.dt.strftime('%Y-%m-%d').fillna(''),
+        'PROV_NET_CLAIMED': pd.to_numeric(_claim_column(claims, 'PROV NET CLAIMED', np.nan), errors='coerce').fillna(0).astype(float),
+        'QTYAPP': quantity,
+    })
+
+class DeductionState:
+    """
+    Per-adherent rule state carried from one batch of claims to the next,
+    kept per rule id.
+
+    last_dates: rule id -> {adherent, or (adherent, sub-key): date of the last matching claim}
+    quantities: rule id -> {adherent, or (adherent, period): running quantity}
+    windows: rule id -> frame of the claims (ADHERENT#, SERVICE, DAY, QTYAPP) still
+        inside a frequency_limit window
+    horizons: rule id -> earliest date its state can still matter for
+    reported_cases: (rule id, SSNBR, adherent, service, tooth) already reported
+    latest: Series of the date of each adherent's (as text) latest claim audited
+        with this state
+    """
+
+    def __init__(self):
+        self.last_dates = {}
+        self.quantities = {}
+        self.windows = {}
+        self.horizons = {}
+        self.reported_cases = set()
+        self.latest = pd.Series(dtype='datetime64[ns]')
+
+def _carried(values, state_map):
+    """Look up state_map for each value, touching each distinct value once"""
+    if not state_map:
+        return pd.Series(np.nan, index=values.index)
+    uniques = values.dropna().unique()
+    return values.map({v: state_map[v] for v in uniques if v in state_map})
+
+def _check_claim_order(claims, state):
+    """
+    Raise ValueError if an adherent has a claim dated before the latest claim
+    already audited with state (periods must be audited in date order), then
+    record the latest claim of each adherent in claims.
+    """
+    codes, adherents = pd.factorize(claims['ADHERENT#'])
+    adherents = pd.Index(adherents).astype(str)
+    days = claims['TRX_DATE'].to_numpy(dtype='datetime64[ns]')
+    dated = (codes >= 0) & ~np.isnat(days)
+    codes, days = codes[dated], days[dated].view('int64')
+    if len(state.latest):
+        first = np.full(len(adherents), np.iinfo(np.int64).max)
+        np.minimum.at(first, codes, days)
+        # NaT (no earlier claim) is the smallest int64, so it never compares greater
+        carried = state.latest.reindex(adherents).to_numpy(dtype='datetime64[ns]').view('int64')
+        early = np.flatnonzero(first < carried)
+        if len(early):
+            i = early[0]
+            raise ValueError(f"adherent {adherents[i]} has a claim dated {pd.Timestamp(first[i]):%Y-%m-%d}, before "
+                             f"claims already audited ({pd.Timestamp(carried[i]):%Y-%m-%d}); "
+                             f"audit periods in date order")
+    latest = np.full(len(adherents), np.iinfo(np.int64).min)
+    np.maximum.at(latest, codes, days)
+    seen = latest > np.iinfo(np.int64).min
+    latest = pd.Series(latest[seen].view('datetime64[ns]'), index=adherents[seen])
+    if len(state.latest):
+        latest = pd.concat([latest, state.latest[~state.latest.index.isin(latest.index)]])
+    state.latest = latest
+
+def _group_keys(keys, group_ids):
+    """Key of each group number: the adherent, or an (adherent, period) tuple"""
+    first = np.unique(group_ids, return_index=True)[1]
+    columns = [key.to_numpy()[first].tolist() for key in keys]
+    return columns[0] if len(columns) == 1 else list(zip(*columns))
+
+@deduction_rule_kind('repeat_within_days',
+                     ['SSNBR', 'PROVIDER', 'ADHERENT#', 'SERVICE', 'GM_ITEM_DESCRIPTION', 'PROV_ITEM_DESC',
+                      'TOOTH_NUMBER', 'PATIENT_AGE', 'TRX DATE', 'PREVIOUS_DATE',
+                      'PROV_NET_CLAIMED', 'QTYAPP', 'REASON'],
+                     'Repeated within {window_days} days')
+def _repeat_within_days_cases(claims, rule, state):
+    """A matching claim less than window_days after the adherent's previous one"""
+    claims = claims[claims['TRX_DATE'].notna() & claims['ADHERENT#'].notna()]
+    if claims.empty:
+        return claims
+    by_adherent = claims.groupby('ADHERENT#', sort=False, observed=True)['TRX_DATE']
+    last_dates = state.last_dates.setdefault(rule.rule_id, {})
+    previous = by_adherent.shift()
+    if last_dates:
+        # all-missing lookups come back as float
+        previous = previous.fillna(pd.to_datetime(_carried(claims['ADHERENT#'], last_dates)))
+    last_dates.update(by_adherent.last().to_dict())
+    # a carried date after the claim (periods out of order) is never a repeat
+    gap = claims['TRX_DATE'] - previous
+    hits = claims[(gap >= pd.Timedelta(0)) & (gap < pd.Timedelta(days=rule.window_days))].copy()
+    hits['PREVIOUS_DATE'] = previous[hits.index].dt.strftime('%Y-%m-%d')
+    hits['REASON'] = _reason(rule)
+    return hits
+
+@deduction_rule_kind('quantity_cap',
+                     ['SSNBR', 'PROVIDER', 'ADHERENT#', 'SERVICE', 'GM_ITEM_DESCRIPTION', 'PROV_ITEM_DESC',
+                      'TOOTH_NUMBER', 'PATIENT_AGE', 'TRX DATE', 'TOTAL_QUANTITY', 'EXCESS_QUANTITY',
+                      'PROV_NET_CLAIMED', 'QTYAPP', 'REASON'],
+                     'Quantity over {max_quantity} (total {total_quantity})')
+def _quantity_cap_cases(claims, rule, state):
+    """
+    Quantity beyond max_quantity per adherent (per calendar period when the
+    rule has one), with PROV_NET_CLAIMED prorated to the excess
+    """
+    claims = claims[claims['ADHERENT#'].notna()]
+    keys = [claims['ADHERENT#']]
+    if rule.period:
+        keys.append(claims['TRX_DATE'].dt.strftime(RULE_PERIODS[rule.period]).fillna(''))
+    by_key = claims.groupby(keys, sort=False, observed=True)['QTYAPP']
+    group_ids = by_key.ngroup().to_numpy()
+    group_keys = _group_keys(keys, group_ids)
+    totals = state.quantities.setdefault(rule.rule_id, {})
+    carried = np.full(len(group_keys), np.nan)
+    if totals:
+        carried = np.array([totals.get(key, np.nan) for key in group_keys], dtype=float)
+    carried_qty = pd.Series(carried[group_ids], index=claims.index)
+    total_qty = by_key.cumsum() + carried_qty.fillna(0).astype('int64')
+    # the first claim of an adherent (and period) only opens the running total
+    seen = (by_key.cumcount() > 0) | carried_qty.notna()
+    over = seen & (total_qty > rule.max_quantity)
+    totals.update(zip(group_keys, total_qty.groupby(group_ids).last().tolist()))
+    hits = claims[over].copy()
+    total_qty = total_qty[over]
+    quantity = hits['QTYAPP']
+    excess_qty = np.minimum(total_qty - rule.max_quantity, quantity)
+    hits['TOTAL_QUANTITY'] = total_qty
+    hits['EXCESS_QUANTITY'] = excess_qty
+    hits['PROV_NET_CLAIMED'] = (hits['PROV_NET_CLAIMED'] / quantity * excess_qty).where(quantity != 0, 0.0)
+    hits['REASON'] = total_qty.map({total: _reason(rule, total_quantity=total) for total in total_qty.unique()})
+    return hits
+
+class AgeRuleIndex:
+    """
+    Age bounds of the rules keyed on (serv_cat, tooth_number).
+
+    Built once from the rules table; the first rule of each pair wins, as in
+    the original row-by-row filter, and missing bounds default to 0 and 120.
+    """
+
+    def __init__(self, serv_cats, tooth_numbers, min_ages, max_ages):
+        self._keys = pd.MultiIndex.from_arrays([
+            np.asarray(serv_cats, dtype=object),
+            np.asarray(tooth_numbers, dtype=float),
+        ])
+        self._min_ages = np.asarray(min_ages, dtype='int64')
+        self._max_ages = np.asarray(max_ages, dtype='int64')
+        self._bounds = dict(zip(zip(self._keys.get_level_values(0), self._keys.get_level_values(1)),
+                                zip(self._min_ages.tolist(), self._max_ages.tolist())))
+
+    @classmethod
+    def from_rules(cls, rules_df):
+        if rules_df is None or rules_df.empty:
+            return cls([], [], [], [])
+        tooth = rules_df['tooth_number']
+        if tooth.dtype == object:
+            # text tooth numbers never compare equal to an extracted number
+            tooth = tooth.map(lambda v: v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan)
+        bounds = pd.DataFrame({
+            'serv_cat': rules_df['serv_cat'],
+            'tooth_number': pd.to_numeric(tooth, errors='coerce'),
+            'min_age': pd.to_numeric(rules_df.get('min_patient_age'), errors='coerce').fillna(0),
+            'max_age': pd.to_numeric(rules_df.get('max_patient_age'), errors='coerce').fillna(120),
+        })
+        bounds = bounds.dropna(subset=['serv_cat', 'tooth_number'])
+        bounds = bounds.drop_duplicates(['serv_cat', 'tooth_number'], keep='first')
+        return cls(bounds['serv_cat'], bounds['tooth_number'], bounds['min_age'], bounds['max_age'])
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, service, tooth_number):
+        """(min_age, max_age) for one claim, or None when no rule matches"""
+        try:
+            return self._bounds.get((service, float(tooth_number)))
+        except (TypeError, ValueError):
+            return None
+
+    def join(self, services, tooth_numbers):
+        """
+        Vectorized lookup for whole columns.
+
+        Returns (matched, min_ages, max_ages) arrays aligned with the input;
+        the age arrays are only meaningful where matched is True.
+        """
+        teeth = pd.to_numeric(pd.Series(tooth_numbers), errors='coerce').to_numpy(dtype=float)
+        if not len(self._keys):
+            empty = np.zeros(len(teeth), dtype='int64')
+            return np.zeros(len(teeth), dtype=bool), empty, empty
+        wanted = pd.MultiIndex.from_arrays([np.asarray(services, dtype=object), teeth])
+        positions = self._keys.get_indexer(wanted)
+        matched = positions >= 0
+        positions = np.where(matched, positions, 0)
+        return matched, self._min_ages[positions], self._max_ages[positions]
+
+@deduction_rule_kind('frequency_limit',
+                     ['SSNBR', 'PROVIDER', 'ADHERENT#', 'SERVICE', 'GM_ITEM_DESCRIPTION', 'PROV_ITEM_DESC',
+                      'TOOTH_NUMBER', 'PATIENT_AGE', 'TRX DATE', 'TOTAL_QUANTITY', 'EXCESS_QUANTITY',
+                      'PROV_NET_CLAIMED', 'QTYAPP', 'REASON'],
+                     'More than {max_quantity} in {window_days} days (total {total_quantity})')
+def _frequency_limit_cases(claims, rule, state):
+    """
+    Quantity beyond max_quantity within any window_days days per adherent and
+    service, with PROV_NET_CLAIMED prorated to the excess.
+
+    Every (adherent, service) pair is evaluated in the same pass: claims are
+    sorted on a (pair, day) key, the start of each claim's window is found
+    with searchsorted, and its rolling total is a difference of one cumsum.
+    """
+    claims = claims[claims['TRX_DATE'].notna() & claims['ADHERENT#'].notna() & claims['SERVICE'].notna()]
+    group_ids = claims.groupby(['ADHERENT#', 'SERVICE'], sort=False, observed=True).ngroup().to_numpy()
+    first = np.unique(group_ids, return_index=True)[1]
+    pairs = pd.MultiIndex.from_arrays([claims['ADHERENT#'].to_numpy()[first], claims['SERVICE'].to_numpy()[first]])
+    days = claims['TRX_DATE'].to_numpy().astype('datetime64[D]').astype('int64')
+
+    # claims of earlier batches still inside the window (ADHERENT#, SERVICE, DAY, QTYAPP)
+    window = state.windows.get(rule.rule_id)
+    carried_ids = np.empty(0, dtype='int64')
+    if window is not None and len(window):
+        carried_ids = pairs.get_indexer(pd.MultiIndex.from_arrays([window['ADHERENT#'], window['SERVICE']]))
+        other_pairs = window[carried_ids < 0]
+        window = window[carried_ids >= 0]
+        carried_ids = carried_ids[carried_ids >= 0]
+    else:
+        other_pairs = window = pd.DataFrame({'ADHERENT#': [], 'SERVICE': [], 'DAY': [], 'QTYAPP': []})
+    all_ids = np.concatenate([carried_ids, group_ids])
+    all_days = np.concatenate([window['DAY'].to_numpy(dtype='int64'), days])
+    all_qty = np.concatenate([window['QTYAPP'].to_numpy(dtype='int64'), claims['QTYAPP'].to_numpy()])
+    # carried claims come first, and claims of one day keep their file order
+    order = np.lexsort((np.arange(len(all_ids)), all_days, all_ids))
+
+    totals = np.zeros(len(all_ids), dtype='int64')
+    if len(order):
+        first_day = all_days.min()
+        span = all_days.max() - first_day + rule.window_days + 1
+        sort_key = all_ids[order] * span + (all_days[order] - first_day)
+        running = np.concatenate([[0], np.cumsum(all_qty[order])])
+        window_start = np.searchsorted(sort_key, sort_key - rule.window_days + 1, side='left')
+        totals[order] = running[1:] - running[window_start]
+
+        # only claims less than window_days before the latest one can count for later claims
+        horizon = all_days.max() - rule.window_days + 1
+        recent = order[all_days[order] >= horizon]
+        starts = np.flatnonzero(np.diff(sort_key[all_days[order] >= horizon], prepend=-1))
+        recent_ids = all_ids[recent][starts]
+        frames = [other_pairs[other_pairs['DAY'] >= horizon]] if len(other_pairs) else []
+        state.windows[rule.rule_id] = pd.concat(frames + [
+            pd.DataFrame({
+                'ADHERENT#': pairs.get_level_values(0)[recent_ids],
+                'SERVICE': pairs.get_level_values(1)[recent_ids],
+                'DAY': all_days[recent][starts],
+                'QTYAPP': np.add.reduceat(all_qty[recent], starts) if len(starts) else np.empty(0, dtype='int64'),
+            }),
+        ], ignore_index=True)
+        state.horizons[rule.rule_id] = pd.Timestamp(horizon, unit='D')
+
+    total_qty = pd.Series(totals[len(carried_ids):], index=claims.index)
+    excess_qty = np.minimum(total_qty - rule.max_quantity, claims['QTYAPP'])
+    over = excess_qty > 0
+    hits = claims[over].copy()
+    total_qty = total_qty[over]
+    excess_qty = excess_qty[over]
+    hits['TOTAL_QUANTITY'] = total_qty
+    hits['EXCESS_QUANTITY'] = excess_qty
+    hits['PROV_NET_CLAIMED'] = hits['PROV_NET_CLAIMED'] / hits['QTYAPP'] * excess_qty
+    hits['REASON'] = total_qty.map({total: _reason(rule, total_quantity=total) for total in total_qty.unique()})
+    return hits
+
+@deduction_rule_kind('age_tooth_bounds',
+                     ['SSNBR', 'PROVIDER', 'ADHERENT#', 'SERVICE', 'GM_ITEM_DESCRIPTION', 'TOOTH_NUMBER',
+                      'PATIENT_AGE', 'TRX DATE', 'PROV_NET_CLAIMED', 'QTYAPP', 'REASON'],
+                     'Age outside {min_age}-{max_age}')
+def _age_tooth_bounds_cases(claims, rule, state):
+    """
+    Patient age outside the bounds of the rule (for teeth tooth_from..tooth_to),
+    or, for a rule without bounds, outside those of the (service, tooth) pair
+    in the rules table
+    """
+    if rule.age_index is not None:
+        if not len(rule.age_index):
+            return claims.iloc[0:0]
+        matched, min_ages, max_ages = rule.age_index.join(claims['SERVICE'], claims['TOOTH_NUMBER'])
+    else:
+        teeth = pd.to_numeric(claims['TOOTH_NUMBER'], errors='coerce')
+        matched = np.ones(len(claims), dtype=bool)
+        if rule.tooth_from is not None:
+            matched &= (teeth >= rule.tooth_from).to_numpy()
+        if rule.tooth_to is not None:
+            matched &= (teeth <= rule.tooth_to).to_numpy()
+        min_ages, max_ages = rule.min_age, rule.max_age
+    age = claims['PATIENT_AGE'].to_numpy()
+    hits = claims[matched & ((age < min_ages) | (age > max_ages))]
+    # report each (SSNBR, adherent, service, tooth) case only once
+    case_key = ['SSNBR', 'ADHERENT#', 'SERVICE', 'TOOTH_NUMBER']
+    hits = hits.drop_duplicates(case_key, keep='first').copy()
+    case_ids = [(rule.rule_id,) + case for case in hits[case_key].itertuples(index=False, name=None)]
+    if state.reported_cases:
+        hits = hits[np.array([case_id not in state.reported_cases for case_id in case_ids], dtype=bool)]
+    state.reported_cases.update(case_ids)
+    hits['REASON'] = _reason(rule)
+    return hits
+
+@deduction_rule_kind('duplicate_claims',
+                     ['SSNBR', 'PROVIDER', 'ADHERENT#', 'SERVICE', 'GM_ITEM_DESCRIPTION', 'PROV_ITEM_DESC',
+                      'TOOTH_NUMBER', 'PATIENT_AGE', 'TRX DATE', 'ORIGINAL_DATE', 'DAYS_APART',
+                      'PROV_NET_CLAIMED', 'QTYAPP', 'REASON'],
+                     'Duplicate claim')
+def _duplicate_claims_cases(claims, rule, state):
+    """
+    A claim repeating the adherent, service, tooth and amount of an earlier
+    claim on the same day or at most window_days later; the repeat is
+    deducted in full.
+
+    The original is the previous claim with that key in date order (file
+    order within a day), or, for the first in this batch, the latest one
+    carried in state from earlier batches. A carried claim dated after the
+    claim is never its original, so a duplicate is never dated before it.
+
+    Claims are hashed on that composite key and stably sorted by hash, so
+    within a key they stay in date order and each claim only needs to be
+    compared with its predecessor: O(n log n) for the whole file.
+    """
+    claims = claims[claims['TRX_DATE'].notna() & claims['ADHERENT#'].notna()]
+    key = pd.DataFrame({
+        'ADHERENT#': claims['ADHERENT#'],
+        'SERVICE': claims['SERVICE'],
+        'TOOTH_NUMBER': pd.to_numeric(claims['TOOTH_NUMBER'], errors='coerce'),
+        'AMOUNT': claims['PROV_NET_CLAIMED'].round(2),
+    })
+    hashes = pd.util.hash_pandas_object(key, index=False).to_numpy()
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    days = claims['TRX_DATE'].dt.normalize().to_numpy()[order]
+
+    same_key = np.zeros(len(order), dtype=bool)
+    same_key[1:] = hashes[1:] == hashes[:-1]
+    # a hash collision is never reported: the key columns must really match
+    for column in key.columns:
+        values = key[column].to_numpy()[order]
+        missing = pd.isna(values)
+        same_key[1:] &= (values[1:] == values[:-1]) | (missing[1:] & missing[:-1])
+    previous = np.empty(len(order), dtype='datetime64[ns]')
+    previous[:] = np.datetime64('NaT')
+    previous[1:][same_key[1:]] = days[:-1][same_key[1:]]
+
+    # keys seen in earlier batches: (adherent, key hash in hex) -> last day
+    last_days = state.last_dates.setdefault(rule.rule_id, {})
+    first = np.flatnonzero(~same_key)
+    if last_days:
+        carried_keys = list(last_days)
+        found = pd.Index(np.array([int(h, 16) for _, h in carried_keys], dtype='uint64')).get_indexer(hashes[first])
+        carried_days = np.array([np.datetime64(last_days[k], 'ns') for k in carried_keys], dtype='datetime64[ns]')
+        previous[first[found >= 0]] = carried_days[found[found >= 0]]
+    window = np.timedelta64(rule.window_days, 'D')
+    if len(order):
+        # only keys within the window of the latest claim can still match later claims
+        horizon = days.max() - window
+        state.horizons[rule.rule_id] = pd.Timestamp(horizon)
+        for stale in [k for k, d in last_days.items() if np.datetime64(d, 'ns') < horizon]:
+            del last_days[stale]
+        last = np.append(first[1:], len(order)) - 1
+        last = last[days[last] >= horizon]
+        adherents = key['ADHERENT#'].to_numpy()[order]
+        last_days.update(((adherents[i], f'{hashes[i]:016x}'), pd.Timestamp(days[i])) for i in last)
+
+    apart = days - previous
+    # a carried key dated after the claim (periods out of order) is never a duplicate
+    flagged = ~np.isnat(previous) & (apart >= np.timedelta64(0)) & (apart <= window)
+    positions = claims.index.to_numpy()[order][flagged]
+    hits = claims.loc[positions].copy()
+    days_apart = pd.Series(apart[flagged].astype('timedelta64[D]').astype('int64'), index=hits.index)
+    hits['ORIGINAL_DATE'] = pd.to_datetime(previous[flagged]).strftime('%Y-%m-%d')
+    hits['DAYS_APART'] = days_apart
+    hits['REASON'] = days_apart.map({d: _reason(rule, days_apart=d) for d in days_apart.unique()})
+    return hits.sort_index()
+
+def _rule_text(value):
+    if value is None or pd.isna(value) or not str(value).strip():
+        return None
+    return str(value).strip()
+
+def _rule_number(value, name, minimum=0):
+    if value is None or pd.isna(value):
+        return None
+    number = float(value)
+    if not number.is_integer() or number < minimum:
+        raise ValueError(f'{name} must be a whole number >= {minimum}')
+    return int(number)
+
+def _deduction_rule(row, age_index):
+    """(DeductionRule, enabled) for one deduction_rules row; raises ValueError"""
+    rule_id = _rule_text(row.rule_id)
+    if rule_id is None:
+        raise ValueError('deduction rule without a rule_id')
+    kind = _rule_text(row.kind)
+    try:
+        if kind not in DEDUCTION_RULE_KINDS:
+            raise ValueError(f"unknown kind {kind!r} (expected one of: {', '.join(DEDUCTION_RULE_KINDS)})")
+        rule = DeductionRule(
+            rule_id=rule_id, kind=kind,
+            service=_rule_text(row.service), description=_rule_text(row.description),
+            window_days=_rule_number(row.window_days, 'window_days'),
+            max_quantity=_rule_number(row.max_quantity, 'max_quantity'),
+            period=_rule_text(row.period),
+            tooth_from=_rule_number(row.tooth_from, 'tooth_from'),
+            tooth_to=_rule_number(row.tooth_to, 'tooth_to'),
+            min_age=_rule_number(row.min_age, 'min_age'),
+            max_age=_rule_number(row.max_age, 'max_age'),
+            reason=_rule_text(row.reason) or DEDUCTION_RULE_KINDS[kind][1],
+            age_index=None,
+        )
+        if kind == 'repeat_within_days' and not rule.window_days:
+            raise ValueError('window_days >= 1 is required')
+        if kind == 'duplicate_claims' and rule.window_days is None:
+            raise ValueError('window_days is required (0 for same-day duplicates only)')
+        if kind in ('quantity_cap', 'frequency_limit') and rule.max_quantity is None:
+            raise ValueError('max_quantity is required')
+        if kind == 'frequency_limit' and not rule.window_days:
+            raise ValueError('window_days >= 1 is required')
+        if rule.period is not None and rule.period not in RULE_PERIODS:
+            raise ValueError(f"unknown period {rule.period!r} (expected one of: {', '.join(RULE_PERIODS)})")
+        if kind == 'age_tooth_bounds':
+            if {rule.tooth_from, rule.tooth_to, rule.min_age, rule.max_age} == {None}:
+                rule = rule._replace(age_index=age_index if age_index is not None else AgeRuleIndex.from_rules(None))
+            else:
+                rule = rule._replace(min_age=rule.min_age if rule.min_age is not None else 0,
+                                     max_age=rule.max_age if rule.max_age is not None else 120)
+        try:
+            _reason(rule, total_quantity=0, days_apart=0)
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f'invalid reason template ({e})')
+        enabled = _rule_number(row.enabled, 'enabled')
+    except (TypeError, ValueError, KeyError, IndexError) as e:
+        raise ValueError(f'deduction rule {rule_id}: {e}') from None
+    return rule, enabled is None or bool(enabled)
+
+def deduction_rule_rows(rules_df, age_index=None):
+    """Validated (DeductionRule, enabled) pairs of a deduction_rules frame, in order"""
+    rules_df = rules_df.reindex(columns=DEDUCTION_RULE_COLUMNS).astype(object)
+    rules_df = rules_df.where(rules_df.notna(), None)
+    rows = [_deduction_rule(row, age_index) for row in rules_df.itertuples(index=False)]
+    counts = collections.Counter(rule.rule_id for rule, _ in rows)
+    duplicates = [rule_id for rule_id, count in counts.items() if count > 1]
+    if duplicates:
+        raise ValueError(f"duplicate deduction rule ids: {', '.join(duplicates)}")
+    return rows
+
+class DeductionPlan:
+    """
+    The enabled deduction rules, compiled once per rules version.
+
+    Every rule is a SERVICE / description filter followed by one grouped
+    column operation of its kind, so a rule costs a few vectorized passes
+    over the claims it selects, never a Python branch per claim. Rules
+    sharing a filter share the filtered frame.
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.order = {rule.rule_id: i for i, rule in enumerate(self.rules)}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def columns(self, rule_id):
+        return DEDUCTION_RULE_KINDS[self.rules[self.order[rule_id]].kind][0]
+
+    def hits(self, claims, state):
+        """Flagged claims of every rule, keyed by rule id"""
+        _check_claim_order(claims, state)
+        selected = {}
+        hits = {}
+        for rule in self.rules:
+            selector = (rule.service, rule.description)
+            if selector not in selected:
+                selected[selector] = _select_claims(claims, rule.service, rule.description)
+            hits[rule.rule_id] = DEDUCTION_RULE_KINDS[rule.kind][2](selected[selector], rule, state)
+        return hits
+
+def _select_claims(claims, service, description):
+    mask = None
+    if service is not None:
+        mask = claims['SERVICE'] == service
+    if description is not None:
+        contains = claims['PROV_ITEM_DESC'].str.contains(description, regex=False)
+        mask = contains if mask is None else mask & contains
+    return claims if mask is None else claims[mask]
+
+def compile_deduction_rules(rules_df, age_index=None):
+    """
+    DeductionPlan of the enabled rules in a deduction_rules frame; raises
+    ValueError naming the first invalid rule.
+
+    age_index: AgeRuleIndex used by age_tooth_bounds rules without bounds of their own.
+    """
+    return DeductionPlan(rule for rule, enabled in deduction_rule_rows(rules_df, age_index) if enabled)
+
+def _drop_overlapping_duplicates(cases, plan):
+    """
+    A claim that duplicate_claims flags and other rules also deduct is
+    deducted once: the duplicate row (the claim's full amount) is dropped
+    when the other rules together deduct at least as much, otherwise their
+    rows are. Overlaps between the other rules are all kept.
+    """
+    duplicate_rules = [i for i, rule in enumerate(plan.rules) if rule.kind == 'duplicate_claims']
+    duplicate = cases['_RULE'].isin(duplicate_rules)
+    if not duplicate.any():
+        return cases
+    # a claim flagged by two duplicate_claims rules: the first of them
+    drop = duplicate & cases['_POS'].where(duplicate).duplicated()
+    others = cases.loc[~duplicate].groupby('_POS')['PROV_NET_CLAIMED'].sum()
+    repeats = cases.loc[duplicate & ~drop].groupby('_POS')['PROV_NET_CLAIMED'].sum()
+    overlap = repeats.index.intersection(others.index)
+    keep_others = others[overlap] >= repeats[overlap]
+    drop |= duplicate & cases['_POS'].isin(overlap[keep_others.to_numpy()])
+    drop |= ~duplicate & cases['_POS'].isin(overlap[~keep_others.to_numpy()])
+    return cases[~drop]
+
+def _collect_cases(rule_hits, plan, by_date=False):
+    """
+    Merge the per-rule hits into one frame ordered by claim date, then rule.
+    Every rule reports its own hits, except that a duplicate_claims hit and
+    other rules' hits on the same claim are deducted once (see
+    _drop_overlapping_duplicates).
+
+    by_date: the hits are indexed by file row rather than by date order, so
+    order them by TRX_DATE first (missing dates last, as prepare_claims does).
+    """
+    frames = []
+    for rule_id, hits in rule_hits.items():
+        if hits.empty:
+            continue
+        date = hits['TRX_DATE']
+        hits = hits[[c for c in plan.columns(rule_id) if c in hits.columns]].copy()
+        if by_date:
+            hits['_DATE'] = date
+        hits['_POS'] = hits.index
+        hits['_RULE'] = plan.order[rule_id]
+        frames.append(hits)
+    if not frames:
+        return pd.DataFrame()
+
+    order = ['_DATE', '_POS', '_RULE'] if by_date else ['_POS', '_RULE']
+    cases = pd.concat(frames, ignore_index=True).sort_values(order, kind='mergesort', na_position='last')
+    cases = _drop_overlapping_duplicates(cases, plan)
+    rules_seen = [plan.rules[r].rule_id for r in cases['_RULE'].unique()]
+    columns = list(dict.fromkeys(c for rule_id in rules_seen for c in plan.columns(rule_id) if c in cases.columns))
+    cases = cases[columns].reset_index(drop=True)
+    # plain values in the report, whatever categoricals the claims were loaded with
+    for column in cases.columns[cases.dtypes == 'category']:
+        cases[column] = cases[column].astype(cases[column].cat.categories.dtype)
+    return cases
+
+def apply_deductions(data_df, plan=None, state=None):
+    """
+    Apply deductions based on rules.
+
+    plan: compiled DeductionPlan; the shared rules snapshot's plan when omitted.
+    state: DeductionState to continue from (and update); a fresh one by default.
+    """
+    if plan is None:
+        plan = shared_rules().get().plan
+    if state is None:
+        state = DeductionState()
+    return _collect_cases(plan.hits(prepare_claims(data_df), state), plan)
+
+def _adherent_groups(source, chunksize):
+    """
+    Group number of every adherent (as text), packing whole adherents into
+    groups of about chunksize claims, and the number of the last group,
+    which holds the claims without an adherent. Only ADHERENT# is read.
+    """
+    position = source.tell() if hasattr(source, 'seek') else None
+    options = _claims_read_options(source)
+    counts, missing = [], 0
+    if 'ADHERENT#' in options['usecols']:
+        with pd.read_csv(source, chunksize=CLAIMS_CHUNK_ROWS, encoding=options['encoding'],
+                         usecols=['ADHERENT#'], dtype={'ADHERENT#': 'category'}) as reader:
+            for chunk in reader:
+                adherents = _string_categories(chunk['ADHERENT#'])
+                missing += int(adherents.isna().sum())
+                counts.append(adherents.value_counts(sort=False))
+    if position is not None:
+        source.seek(position)
+    if not counts:
+        return pd.Series(dtype='int64'), 0
+    counts = pd.concat(counts).groupby(level=0, sort=False).sum()
+    counts = counts[counts > 0]
+    # an adherent with more than chunksize claims gets a group to itself
+    groups = (counts.cumsum() - counts) // chunksize
+    return groups, int(groups.max()) + 1 if len(groups) else 0
+
+def _claim_groups(chunk, groups, missing_group):
+    if 'ADHERENT#' not in chunk.columns:
+        return np.full(len(chunk), missing_group)
+    adherents = chunk['ADHERENT#']
+    category_groups = groups.reindex(adherents.cat.categories).fillna(missing_group).to_numpy(dtype='int64')
+    codes = adherents.cat.codes.to_numpy()
+    return np.where(codes >= 0, category_groups[codes], missing_group)
+
+def _spill_claim_groups(source, chunksize, groups, missing_group, spill):
+    """Append each chunk's claims, with their file row as _ROW, to one pickle file per group"""
+    start = 0
+    for chunk in iter_claims(source, chunksize):
+        chunk['_ROW'] = np.arange(start, start + len(chunk))
+        start += len(chunk)
+        for group, part in chunk.groupby(_claim_groups(chunk, groups, missing_group), sort=False):
+            with open(os.path.join(spill, f'{group}.pkl'), 'ab') as f:
+                pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _spilled_frames(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def apply_deductions_streaming(source, chunksize=CLAIMS_CHUNK_ROWS, plan=None, state=None):
+    """
+    Apply deductions to a claims CSV without loading it whole; the result
+    is the same as apply_deductions on the whole file, in any row order.
+
+    Every rule is scoped to one adherent, so the file is split by adherent:
+    a first pass counts the claims of each adherent, a second reads
+    chunksize rows at a time and spills them to a temporary directory in
+    groups of whole adherents of about chunksize claims, and each group is
+    then audited on its own. At most one chunk or group plus the flagged
+    rows is held in memory.
+    """
+    if plan is None:
+        plan = shared_rules().get().plan
+    if state is None:
+        state = DeductionState()
+
+    groups, missing_group = _adherent_groups(source, chunksize)
+    rule_hits = {rule.rule_id: [] for rule in plan.rules}
+    with tempfile.TemporaryDirectory(prefix='claims_groups_') as spill:
+        _spill_claim_groups(source, chunksize, groups, missing_group, spill)
+        for group in range(missing_group + 1):
+            path = os.path.join(spill, f'{group}.pkl')
+            if not os.path.exists(path):
+                continue
+            claims = pd.concat(_spilled_frames(path))
+            os.remove(path)
+            claims = prepare_claims(claims.drop(columns='_ROW'), rows=claims['_ROW'])
+            for rule_id, hits in plan.hits(claims, state).items():
+                if not hits.empty:
+                    rule_hits[rule_id].append(hits)
+            del claims
+    return _collect_cases({rule_id: pd.concat(frames) if frames else pd.DataFrame()
+                           for rule_id, frames in rule_hits.items()}, plan, by_date=True)
+
+def _shard_hits(claims, plan):
+    return plan.hits(claims, DeductionState())
+
+def apply_deductions_parallel(data_df, workers=None, plan=None):
+    """
+    Apply deductions on a process pool, sharding claims by ADHERENT#.
+
+    Every rule is scoped to one adherent, so each shard is independent. Shards
+    keep the global date order, and hits are merged by claim position, so the
+    result is the same as apply_deductions whatever the worker count.
+    """
+    workers = workers or DEDUCTION_WORKERS
+    if plan is None:
+        plan = shared_rules().get().plan
+    if workers <= 1 or len(data_df) < PARALLEL_MIN_ROWS:
+        return apply_deductions(data_df, plan=plan)
+
+    claims = prepare_claims(data_df)
+    shard_ids = pd.util.hash_pandas_object(claims['ADHERENT#'], index=False).to_numpy() % workers
+    shards = [claims[shard_ids == i] for i in range(workers)]
+
+    rule_hits = {rule.rule_id: [] for rule in plan.rules}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for shard_hits in pool.map(_shard_hits, shards, [plan] * workers):
+            for rule_id, hits in shard_hits.items():
+                if not hits.empty:
+                    rule_hits[rule_id].append(hits)
+    return _collect_cases({rule_id: pd.concat(frames) if frames else pd.DataFrame()
+                           for rule_id, frames in rule_hits.items()}, plan)
+
+# ------------------- التدقيق التراكمي بين الفترات -------------------
+def load_deduction_state(adherents=None, db_name=None):
+    """DeductionState saved by earlier periods, restricted to adherents when given"""
+    init_db(db_name)
+    conn = get_connection(db_name)
+    query = "SELECT rule_id, adherent, period, last_date, quantity, events FROM rule_state"
+    if adherents is not None:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted_adherents (adherent text PRIMARY KEY)")
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM wanted_adherents")
+        conn.executemany("INSERT OR IGNORE INTO wanted_adherents VALUES (?)", ((str(a),) for a in adherents))
+        conn.execute("COMMIT")
+        query += " JOIN wanted_adherents USING (adherent)"
+
+    state = DeductionState()
+    windows = collections.defaultdict(list)
+    latest = {}
+    for rule_id, adherent, period, last_date, quantity, events in conn.execute(query):
+        if last_date is not None:
+            latest[adherent] = max(latest.get(adherent, last_date), last_date)
+        if events is not None:
+            windows[rule_id] += [(adherent, period, day, qty) for day, qty in json.loads(events)]
+        elif last_date is not None:
+            state.last_dates.setdefault(rule_id, {})[(adherent, period) if period else adherent] = pd.Timestamp(last_date)
+        if quantity is not None:
+            state.quantities.setdefault(rule_id, {})[(adherent, period) if period else adherent] = quantity
+    for rule_id, events in windows.items():
+        state.windows[rule_id] = pd.DataFrame(events, columns=['ADHERENT#', 'SERVICE', 'DAY', 'QTYAPP'])
+    if latest:
+        state.latest = pd.Series(pd.to_datetime(list(latest.values())).as_unit('ns'), index=list(latest))
+    return state
+
+def is_period_committed(period_id, db_name=None):
+    init_db(db_name)
+    return get_connection(db_name).execute(
+        "SELECT 1 FROM audit_periods WHERE period_id = ?", (period_id,)).fetchone() is not None
+
+def commit_deduction_state(state, period_id, name=None, claims=None, db_name=None):
+    """
+    Save the state of the adherents in state and record the period, in one
+    transaction. Raises ValueError if the period was already committed, so
+    a file's quantities are never counted twice.
+    """
+    init_db(db_name)
+    conn = get_connection(db_name)
+    rows = []
+    for rule_id, last_dates in state.last_dates.items():
+        for key, last_date in last_dates.items():
+            if not pd.isna(last_date):
+                adherent, period = key if isinstance(key, tuple) else (key, '')
+                rows.append((rule_id, str(adherent), period, pd.Timestamp(last_date).isoformat(), None))
+    for rule_id, quantities in state.quantities.items():
+        for key, quantity in quantities.items():
+            adherent, period = key if isinstance(key, tuple) else (key, '')
+            rows.append((rule_id, str(adherent), period, None, int(quantity)))
+    rows = [row + (None,) for row in rows]
+    for rule_id, window in state.windows.items():
+        for (adherent, service), events in window.groupby(['ADHERENT#', 'SERVICE'], sort=False):
+            events = events[['DAY', 'QTYAPP']].to_numpy(dtype='int64').tolist()
+            rows.append((rule_id, str(adherent), str(service),
+                         pd.Timestamp(max(day for day, _ in events), unit='D').isoformat(), None, json.dumps(events)))
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        try:
+            conn.execute("INSERT INTO audit_periods (period_id, name, claims, committed_at) VALUES (?, ?, ?, ?)",
+                         (period_id, name, claims, pd.Timestamp.now().isoformat(timespec='seconds')))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"period {name or period_id} was already audited incrementally")
+        # state older than a rule's horizon can no longer match any later claim
+        conn.executemany("DELETE FROM rule_state WHERE rule_id = ? AND last_date < ?",
+                         [(rule_id, horizon.isoformat()) for rule_id, horizon in state.horizons.items()])
+        conn.executemany('''INSERT INTO rule_state (rule_id, adherent, period, last_date, quantity, events)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (rule_id, adherent, period) DO UPDATE SET
+                              last_date = coalesce(excluded.last_date, last_date),
+                              quantity = coalesce(excluded.quantity, quantity),
+                              events = coalesce(excluded.events, events)''', rows)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def load_period_state(data_df, period_id, name=None, db_name=None):
+    """
+    (data_df with ADHERENT# as text, DeductionState of its adherents saved by
+    earlier periods). Raises ValueError if the period was already committed.
+    """
+    if is_period_committed(period_id, db_name):
+        raise ValueError(f"period {name or period_id} was already audited incrementally")
+    if 'ADHERENT#' in data_df.columns:
+        # state is keyed on the adherent as text
+        data_df = data_df.assign(**{'ADHERENT#': _string_categories(data_df['ADHERENT#'])})
+        adherents = data_df['ADHERENT#'].cat.categories
+    else:
+        adherents = ['']
+    return data_df, load_deduction_state(adherents, db_name)
+
+def apply_deductions_incremental(data_df, period_id, name=None, plan=None, db_name=None):
+    """
+    Apply deductions to one period's claims only, continuing the deduction
+    rules from the state saved by earlier periods, then save the updated
+    state. period_id identifies the period (e.g. the file's sha256). Periods
+    must be audited in date order: a period with a claim dated before an
+    already audited claim of the same adherent raises ValueError.
+    """
+    data_df, state = load_period_state(data_df, period_id, name, db_name)
+    cases = apply_deductions(data_df, plan=plan, state=state)
+    commit_deduction_state(state, period_id, name=name, claims=len(data_df), db_name=db_name)
+    return cases
+
+ANOMALY_EXCLUDED_SERVICES = ['XRD', 'IOE', 'CL']
+ANOMALY_FEATURES = ['PROV NET CLAIMED', 'QTYAPP', 'SERVICE_COUNT', 'TOTAL_COST', 'DAYS_SINCE_LAST']
+# per-adherent aggregates the risk levels are based on
+RISK_FEATURES = ['SERVICE_COUNT', 'TOTAL_COST']
+# RISK_LEVEL values, most severe first; anomaly results are sorted in this order
+RISK_LEVELS = ['high risk', 'medium risk', 'low risk']
+
+# name -> (claims columns it reads, builder(claims, groups)); builders get the scored
+# claims sorted by TRX DATE (and groups = claims.groupby('ADHERENT#')) and return one
+# value per claim. Register new features with @anomaly_feature and add them to
+# ANOMALY_FEATURES to train on them; stored models keep the list they were fitted on.
+ANOMALY_FEATURE_BUILDERS = {}
+
+def anomaly_feature(name, *columns):
+    def register(builder):
+        ANOMALY_FEATURE_BUILDERS[name] = (columns, builder)
+        return builder
+    return register
+
+@anomaly_feature('PROV NET CLAIMED', 'PROV NET CLAIMED')
+def _claimed_feature(claims, groups):
+    return claims['PROV NET CLAIMED']
+
+@anomaly_feature('QTYAPP', 'QTYAPP')
+def _quantity_feature(claims, groups):
+    return claims['QTYAPP']
+
+@anomaly_feature('SERVICE_COUNT', 'SERVICE')
+def _service_count_feature(claims, groups):
+    return groups['SERVICE'].transform('count')
+
+@anomaly_feature('TOTAL_COST', 'PROV NET CLAIMED')
+def _total_cost_feature(claims, groups):
+    return groups['PROV NET CLAIMED'].transform('sum')
+
+@anomaly_feature('DAYS_SINCE_LAST', 'TRX DATE')
+def _days_since_last_feature(claims, groups):
+    if 'TRX DATE' not in claims.columns:
+        return 0
+    return groups['TRX DATE'].diff().dt.days.fillna(0)
+
+@anomaly_feature('SERVICE_FREQUENCY', 'SERVICE')
+def _service_frequency_feature(claims, groups):
+    # claims of the same service by the same adherent
+    return claims.groupby(['ADHERENT#', 'SERVICE'], observed=True)['SERVICE'].transform('count')
+
+def anomaly_features(data_df, names=None):
+    """
+    Anomaly features (ANOMALY_FEATURES by default) of the claims considered
+    for anomaly detection, indexed by their row positions in data_df; None
+    if there is nothing to score.
+
+    Only the columns the features read are copied, sorted once by date, and
+    every feature is a transform over that one adherent grouping.
+    """
+    names = list(names or ANOMALY_FEATURES)
+    if data_df is None or data_df.empty or 'SERVICE' not in data_df.columns:
+        return None
+    scored = ~data_df['SERVICE'].isin(ANOMALY_EXCLUDED_SERVICES) & data_df['ADHERENT#'].notna()
+    positions = np.flatnonzero(scored.to_numpy())
+    if len(positions) == 0:
+        return None
+
+    columns = ['ADHERENT#']
+    for name in names:
+        columns += ANOMALY_FEATURE_BUILDERS[name][0]
+    columns = [c for c in dict.fromkeys(columns) if c in data_df.columns]
+    claims = data_df[columns].iloc[positions]
+    claims.index = positions
+    if 'TRX DATE' in claims.columns:
+        claims = claims.sort_values('TRX DATE', kind='mergesort')
+    groups = claims.groupby('ADHERENT#', observed=True, sort=False)
+
+    features = pd.DataFrame(index=claims.index)
+    for name in names:
+        features[name] = ANOMALY_FEATURE_BUILDERS[name][1](claims, groups)
+    return features.sort_index()
+
+def fit_anomaly_model(features, n_estimators=None, max_samples=None, fit_rows=None, n_jobs=None):
+    """
+    Scaler and IsolationForest fitted on a feature matrix; options default
+    to the ANOMALY_* settings. Above fit_rows rows both are fitted on a
+    seeded random sample, so the fit stays bounded and reproducible.
+    """
+    fit_rows = fit_rows or ANOMALY_FIT_MAX_ROWS
+    if len(features) > fit_rows:
+        rng = np.random.default_rng(ANOMALY_RANDOM_STATE)
+        features = features.iloc[np.sort(rng.choice(len(features), fit_rows, replace=False))]
+    scaler = StandardScaler()
+    X = scaler.fit_transform(features)
+    clf = IsolationForest(n_estimators=n_estimators or ANOMALY_N_ESTIMATORS,
+                          max_samples=max_samples or ANOMALY_MAX_SAMPLES,
+                          contamination=0.1, random_state=ANOMALY_RANDOM_STATE,
+                          n_jobs=n_jobs or ANOMALY_N_JOBS)
+    clf.fit(X)
+    return scaler, clf
+
+def score_anomalies(scaler, clf, features, chunk_rows=None, n_jobs=None):
+    """
+    decision_function of every row, scaled and scored chunk by chunk so the
+    scaled matrix is never held whole; trees are walked on n_jobs threads.
+    """
+    chunk_rows = chunk_rows or ANOMALY_SCORE_CHUNK_ROWS
+    scores = np.empty(len(features))
+    with joblib.parallel_backend('threading', n_jobs=n_jobs or ANOMALY_N_JOBS):
+        for start in range(0, len(features), chunk_rows):
+            chunk = features.iloc[start:start + chunk_rows]
+            scores[start:start + len(chunk)] = clf.decision_function(scaler.transform(chunk))
+    return scores
+
+def detect_fraud_with_isolation(data_df, model=None, **fit_options):
+    """
+    Detect anomalies using Isolation Forest.
+
+    model: AnomalyModel trained on a baseline period; the file is then only
+    scored against it, so scores are comparable between files. Without one
+    a model is fitted on the file itself, with fit_options passed to
+    fit_anomaly_model.
+    """
+    names = list(model.features) if model is not None else ANOMALY_FEATURES
+    with stage('anomaly_features', len(data_df) if data_df is not None else 0):
+        features = anomaly_features(data_df, list(dict.fromkeys(names + RISK_FEATURES)))
+    if features is None:
+        return pd.DataFrame()
+
+    if model is None:
+        with stage('isolation_fit', len(features)):
+            scaler, clf = fit_anomaly_model(features[names], **fit_options)
+    else:
+        scaler, clf = model.scaler, model.forest
+    # decision_function < 0 is exactly what predict() reports as -1
+    with stage('isolation_score', len(features)):
+        scores = score_anomalies(scaler, clf, features[names], n_jobs=fit_options.get('n_jobs'))
+    is_fraud = scores < 0
+    if not is_fraud.any():
+        return pd.DataFrame()
+
+    # only the flagged claims are copied out of the (possibly wide) claims frame
+    flagged = features.index[is_fraud]
+    result_df = data_df.iloc[flagged].copy()
+    for name in RISK_FEATURES:
+        result_df[name] = features[name].to_numpy()[is_fraud]
+    result_df['ANOMALY_SCORE'] = -scores[is_fraud]
+
+    # Risk level
+    conditions = [
+        (result_df['TOTAL_COST'] > result_df['TOTAL_COST'].quantile(0.9)) &
+        (result_df['SERVICE_COUNT'] > result_df['SERVICE_COUNT'].quantile(0.9)),
+        (result_df['TOTAL_COST'] > result_df['TOTAL_COST'].quantile(0.75)) |
+        (result_df['SERVICE_COUNT'] > result_df['SERVICE_COUNT'].quantile(0.75))
+    ]
+    result_df['RISK_LEVEL'] = np.select(conditions, RISK_LEVELS[:2], default=RISK_LEVELS[2])
+
+    columns_to_export = [
+        'SSNBR', 'PROVIDER', 'ADHERENT#', 'SERVICE', 'GM ITEM DESCRIPTION',
+        'PROV ITEM DESC MAPPING', 'TRX DATE', 'PROV NET CLAIMED',
+        'QTYAPP', 'SERVICE_COUNT', 'TOTAL_COST', 'ANOMALY_SCORE', 'RISK_LEVEL'
+    ]
+    # Keep only columns that exist
+    columns_to_export = [c for c in columns_to_export if c in result_df.columns]
+    result_df = result_df[columns_to_export]
+
+    # Format
+    if 'TRX DATE' in result_df.columns:
+        try:
+            result_df['TRX DATE'] = pd.to_datetime(result_df['TRX DATE']).dt.strftime('%Y-%m-%d')
+        except Exception:
+            pass
+    if 'PROV NET CLAIMED' in result_df.columns:
+        result_df['PROV NET CLAIMED'] = result_df['PROV NET CLAIMED'].round(2)
+    if 'TOTAL_COST' in result_df.columns:
+        result_df['TOTAL_COST'] = result_df['TOTAL_COST'].round(2)
+    if 'ANOMALY_SCORE' in result_df.columns:
+        result_df['ANOMALY_SCORE'] = result_df['ANOMALY_SCORE'].round(4)
+
+    # Sort by risk
+    order_map = {level: i for i, level in enumerate(RISK_LEVELS)}
+    result_df['R_ORDER'] = result_df['RISK_LEVEL'].map(order_map).fillna(3)
+    result_df = result_df.sort_values(['R_ORDER', 'ANOMALY_SCORE']).drop(columns=['R_ORDER'])
+
+    return result_df
+
+def risk_tiers(anomaly_df):
+    """
+    (risk level, rows) for each of RISK_LEVELS. The rows are slices of
+    anomaly_df, which detect_fraud_with_isolation sorts by risk level, so
+    no tier is copied.
+    """
+    if anomaly_df is None or anomaly_df.empty:
+        return [(level, pd.DataFrame()) for level in RISK_LEVELS]
+    order = anomaly_df['RISK_LEVEL'].map({level: i for i, level in enumerate(RISK_LEVELS)}).to_numpy()
+    bounds = np.searchsorted(order, np.arange(len(RISK_LEVELS) + 1))
+    return [(level, anomaly_df.iloc[bounds[i]:bounds[i + 1]]) for i, level in enumerate(RISK_LEVELS)]
+
+# ------------------- سجل نماذج كشف الشذوذ -------------------
+AnomalyModel = collections.namedtuple(
+    'AnomalyModel', ['model_id', 'trained_at', 'trained_on', 'claims', 'features', 'scaler', 'forest'])
+
+def train_anomaly_model(data_df, trained_on=None, db_name=None, **fit_options):
+    """
+    Fit the anomaly model on a baseline period (fit_options as for
+    fit_anomaly_model) and store it as the current model; later files are
+    scored against it until the next retrain. Returns the AnomalyModel.
+    """
+    features = anomaly_features(data_df)
+    if features is None:
+        raise ValueError('the baseline file has no claims to train the anomaly model on')
+    scaler, forest = fit_anomaly_model(features, **fit_options)
+    trained_at = pd.Timestamp.now().isoformat(timespec='seconds')
+
+    init_db(db_name)
+    conn = get_connection(db_name)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.execute(
+            '''INSERT INTO anomaly_models (trained_at, trained_on, claims, features, sklearn_version, model)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (trained_at, trained_on, len(features), json.dumps(list(features.columns)), sklearn.__version__,
+             pickle.dumps((scaler, forest), protocol=pickle.HIGHEST_PROTOCOL)))
+        model_id = cursor.lastrowid
+        conn.execute("DELETE FROM anomaly_models WHERE model_id <= ?", (model_id - ANOMALY_MODELS_KEPT,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return AnomalyModel(model_id, trained_at, trained_on, len(features), tuple(features.columns), scaler, forest)
+
+def anomaly_model_id(db_name=None):
+    """Id of the newest stored model (None if none was trained)"""
+    try:
+        return get_connection(db_name).execute("SELECT max(model_id) FROM anomaly_models").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+def load_anomaly_model(db_name=None):
+    """
+    The newest stored AnomalyModel, or None. A model pickled by another
+    scikit-learn version, or one that cannot be unpickled, is not used:
+    a warning asks for a retrain and every file is fitted on its own.
+    """
+    try:
+        row = get_connection(db_name).execute(
+            '''SELECT model_id, trained_at, trained_on, claims, features, sklearn_version, model
+               FROM anomaly_models ORDER BY model_id DESC LIMIT 1''').fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+    model_id, trained_at, trained_on, claims, features, sklearn_version, blob = row
+    if sklearn_version != sklearn.__version__:
+        log.warning("anomaly model %s was trained with scikit-learn %s, this is %s; it is not used and each "
+                    "file is scored on its own until the model is retrained", model_id, sklearn_version,
+                    sklearn.__version__)
+        return None
+    try:
+        # the table is written only by train_anomaly_model
+        scaler, forest = pickle.loads(blob)
+    except Exception as e:
+        log.warning("anomaly model %s cannot be loaded (%s); it is not used and each file is scored on its "
+                    "own until the model is retrained", model_id, e)
+        return None
+    return AnomalyModel(model_id, trained_at, trained_on, claims, tuple(json.loads(features)), scaler, forest)
+
+class AnomalyModelRegistry:
+    """
+    The current anomaly model of a database, loaded once per process and
+    shared like the rules snapshot. get() returns None until a model has
+    been trained.
+    """
+
+    def __init__(self, db_name=None):
+        self.db_name = db_name
+        self._model = None
+        # newest stored model id when last loaded, even if that model was not usable
+        self._model_id = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._model_id = anomaly_model_id(self.db_name)
+        self._model = load_anomaly_model(self.db_name)
+        self._loaded = True
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+        return self._model
+
+    @property
+    def unusable(self):
+        """True when a model is stored but could not be used (see load_anomaly_model)"""
+        self.get()
+        return self._model_id is not None and self._model is None
+
+    def refresh(self):
+        """Reload only if another process trained a newer model"""
+        model = self.get()
+        if anomaly_model_id(self.db_name) != self._model_id:
+            with self._lock:
+                self._load()
+                model = self._model
+        return model
+
+    def train(self, data_df, trained_on=None, **fit_options):
+        model = train_anomaly_model(data_df, trained_on=trained_on, db_name=self.db_name, **fit_options)
+        with self._lock:
+            self._model = model
+            self._model_id = model.model_id
+            self._loaded = True
+        return model
+
+_model_registries = {}
+
+def shared_anomaly_model(db_name=None):
+    """The process-wide AnomalyModelRegistry for db_name"""
+    db_name = db_name or DB_NAME
+    with _registries_lock:
+        if db_name not in _model_registries:
+            _model_registries[db_name] = AnomalyModelRegistry(db_name)
+        return _model_registries[db_name]
+
+# ------------------- قراءة ملفات المطالبات -------------------
+# the only claims columns the audit reads; codes and descriptions repeat a lot
+# and are held as categoricals, numbers are downcast after parsing
+CLAIMS_SCHEMA = {
+    'SSNBR': 'category',
+    # optional; reported with the results and used by the dashboard cube
+    'PROVIDER': 'category',
+    'ADHERENT#': 'category',
+    'SERVICE': 'category',
+    'GM ITEM DESCRIPTION': 'category',
+    'PROV ITEM DESC MAPPING': 'category',
+    'TRX DATE': 'datetime64[ns]',
+    'AGE': 'float32',
+    'QTYAPP': 'float32',
+    # float32 cannot hold amounts to the cent, and this column is summed into totals
+    'PROV NET CLAIMED': 'float64',
+}
+# explicit TRX DATE format; when None it is detected once per file from its distinct values
+CLAIMS_DATE_FORMAT = None
+DATE_FORMAT_CANDIDATES = (
+    '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y', '%d/%m/%Y', '%d-%m-%Y',
+    '%m/%d/%Y %H:%M', '%d/%m/%Y %H:%M', '%d-%b-%Y', '%d-%b-%y',
+)
+# the pyarrow CSV reader is multi-threaded; pandas' C parser is used for chunked reads
+CSV_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+
+def _distinct_dates(values):
+    return pd.Series(pd.Series(values).dropna().unique()).astype(str).unique()
+
+def detect_date_format(values):
+    """
+    First candidate format that parses every distinct value, or None. All
+    values are checked, not a sample: a day-first file whose first rows
+    all have days up to 12 would otherwise be read month-first.
+    """
+    distinct = pd.Series(_distinct_dates(values))
+    if not len(distinct):
+        return None
+    for date_format in DATE_FORMAT_CANDIDATES:
+        if pd.to_datetime(distinct, format=date_format, errors='coerce').notna().all():
+            return date_format
+    return None
+
+def _warn_unparsed_dates(values, dates, date_format):
+    """Log the values date_format left unparsed that another candidate would parse"""
+    unparsed = pd.Series(_distinct_dates(values[dates.isna()]))
+    if not len(unparsed):
+        return
+    for candidate in DATE_FORMAT_CANDIDATES:
+        if candidate != date_format and pd.to_datetime(unparsed, format=candidate, errors='coerce').notna().any():
+            log.warning("TRX DATE: %d distinct values such as %r do not match %r but match %r and are read as "
+                        "missing; set CLAIMS_DATE_FORMAT", len(unparsed), unparsed.iloc[0], date_format, candidate)
+            return
+
+def parse_claim_dates(values, date_format=None):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    date_format = date_format or CLAIMS_DATE_FORMAT or detect_date_format(values)
+    if date_format:
+        dates = pd.to_datetime(values, format=date_format, errors='coerce')
+        _warn_unparsed_dates(values, dates, date_format)
+        return dates
+    return pd.to_datetime(values, errors='coerce')
+
+def _string_categories(values):
+    """
+    Categorical with string categories, whichever parser produced it; codes
+    read as floats (a numeric column with blanks) are written without '.0'
+    """
+    values = values.astype('category')
+    categories = values.cat.categories
+    if categories.dtype == object or pd.api.types.is_string_dtype(categories):
+        return values
+    if pd.api.types.is_float_dtype(categories) and (categories == np.floor(categories)).all():
+        categories = categories.astype('int64')
+    return values.cat.rename_categories(categories.astype(str))
+
+def normalize_claims(data_df, date_format=None):
+    """Apply CLAIMS_SCHEMA dtypes, parse dates and extract tooth numbers, in place"""
+    for column, dtype in CLAIMS_SCHEMA.items():
+        if column not in data_df.columns:
+            continue
+        if dtype == 'category':
+            data_df[column] = _string_categories(data_df[column])
+        elif column == 'TRX DATE':
+            data_df[column] = parse_claim_dates(data_df[column], date_format)
+        elif column != 'QTYAPP':
+            data_df[column] = pd.to_numeric(data_df[column], errors='coerce').astype(dtype)
+    if 'QTYAPP' in data_df.columns:
+        data_df['QTYAPP'] = pd.to_numeric(data_df['QTYAPP'], errors='coerce').fillna(1).astype('float32')
+    else:
+        data_df['QTYAPP'] = np.float32(1)
+
+    # extract tooth number heuristic if missing
+    with stage('extract_tooth_numbers', len(data_df)):
+        data_df['EXTRACTED_TOOTH'] = extract_tooth_numbers(data_df.get('GM ITEM DESCRIPTION'))
+    return data_df
+
+def _claims_read_options(source):
+    """
+    usecols/dtype for the schema columns present in the file's header.
+    Codes are read as text categories, so '00123' keeps its zeros, and
+    TRX DATE as text, parsed by normalize_claims; numbers are inferred.
+    """
+    position = source.tell() if hasattr(source, 'seek') else None
+    header = pd.read_csv(source, encoding='utf-8-sig', nrows=0).columns
+    if position is not None:
+        source.seek(position)
+    columns = [c for c in header if c in CLAIMS_SCHEMA]
+    dtype = {c: 'category' if CLAIMS_SCHEMA[c] == 'category' else str
+             for c in columns if CLAIMS_SCHEMA[c] == 'category' or c == 'TRX DATE'}
+    return {'encoding': 'utf-8-sig', 'usecols': columns, 'dtype': dtype}
+
+def _read_csv_pyarrow(source, options):
+    """
+    The schema columns through pyarrow's reader. pandas' pyarrow engine
+    infers every column and casts to dtype afterwards, which strips the
+    zeros of codes and fails on integer columns with blanks, so the text
+    columns are typed in pyarrow itself.
+    """
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    column_types = {c: pa.dictionary(pa.int32(), pa.string()) if dtype == 'category' else pa.string()
+                    for c, dtype in options['dtype'].items()}
+    table = pa_csv.read_csv(source, convert_options=pa_csv.ConvertOptions(
+        include_columns=options['usecols'], column_types=column_types, strings_can_be_null=True))
+    return table.to_pandas()
+
+def load_claims(source):
+    """Read the CLAIMS_SCHEMA columns of a claims CSV, typed and normalised"""
+    options = _claims_read_options(source)
+    with stage('read_csv') as record:
+        # pyarrow needs bytes; text streams go through the C parser
+        if CSV_ENGINE == 'pyarrow' and not isinstance(source, io.TextIOBase):
+            data_df = _read_csv_pyarrow(source, options)
+        else:
+            data_df = pd.read_csv(source, **options)
+        record['rows'] = len(data_df)
+    return normalize_claims(data_df)
+
+def _file_date_format(source, options):
+    """detect_date_format over the distinct TRX DATE values of the whole file; only that column is read"""
+    position = source.tell() if hasattr(source, 'seek') else None
+    distinct = set()
+    if CSV_ENGINE == 'pyarrow' and not isinstance(source, io.TextIOBase):
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv, compute as pa_compute
+
+        reader = pa_csv.open_csv(source, convert_options=pa_csv.ConvertOptions(
+            include_columns=['TRX DATE'], column_types={'TRX DATE': pa.string()}, strings_can_be_null=True))
+        for batch in reader:
+            distinct.update(pa_compute.unique(batch.column(0)).drop_null().to_pylist())
+    else:
+        with pd.read_csv(source, chunksize=CLAIMS_CHUNK_ROWS, encoding=options['encoding'],
+                         usecols=['TRX DATE'], dtype={'TRX DATE': str}) as reader:
+            for chunk in reader:
+                distinct.update(chunk['TRX DATE'].dropna().unique())
+    if position is not None:
+        source.seek(position)
+    return detect_date_format(list(distinct))
+
+def iter_claims(source, chunksize=CLAIMS_CHUNK_ROWS):
+    """
+    Read a claims CSV as normalised chunks of at most chunksize rows. The
+    TRX DATE format is detected once for the whole file, so every chunk
+    reads its dates the way load_claims would.
+    """
+    options = _claims_read_options(source)
+    date_format = CLAIMS_DATE_FORMAT
+    if date_format is None and 'TRX DATE' in options['usecols']:
+        date_format = _file_date_format(source, options)
+    with pd.read_csv(source, chunksize=chunksize, **options) as reader:
+        for chunk in reader:
+            yield normalize_claims(chunk, date_format)
+
+def file_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def path_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _prune_claims_cache(cache_dir):
+    """Keep the CLAIMS_CACHE_MAX_FILES most recently used cache files"""
+    entries = [e for e in os.scandir(cache_dir) if e.name.endswith('.parquet')]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    for entry in entries[CLAIMS_CACHE_MAX_FILES:]:
+        with contextlib.suppress(OSError):
+            os.remove(entry.path)
+
+def load_claims_cached(source, digest=None, cache_dir=None):
+    """
+    load_claims through a Parquet cache of the normalised frame.
+
+    source is the raw file bytes or a path. Entries are keyed by the file's
+    sha256 (pass digest if it is already known), so re-auditing the same
+    file skips CSV parsing, date coercion and tooth extraction. Frames that
+    Parquet cannot store (mixed-type columns) are simply not cached.
+    """
+    cache_dir = cache_dir or CLAIMS_CACHE_DIR
+    if digest is None:
+        digest = file_digest(source) if isinstance(source, bytes) else path_digest(source)
+    cache_path = os.path.join(cache_dir, f'{digest}.v{CLAIMS_CACHE_FORMAT}.parquet')
+
+    if os.path.exists(cache_path):
+        try:
+            with stage('read_claims_cache') as record:
+                data_df = pd.read_parquet(cache_path)
+                record['rows'] = len(data_df)
+            os.utime(cache_path)  # mark as recently used
+            return data_df
+        except Exception:
+            pass  # unreadable entry, rebuilt below
+
+    data_df = load_claims(io.BytesIO(source) if isinstance(source, bytes) else source)
+    tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with stage('write_claims_cache', len(data_df)):
+            data_df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+        _prune_claims_cache(cache_dir)
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+    return data_df
+
+# ------------------- تخزين نتائج التدقيق مؤقتاً -------------------
+class LRUCache:
+    """Thread-safe mapping that keeps at most max_entries, evicting the least recently used"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+# key: (file sha256, rules version, model id) the result was computed for;
+# timings: AuditTrace records of the run that computed it
+AuditResult = collections.namedtuple('AuditResult', ['deductions', 'anomalies', 'key', 'timings'],
+                                     defaults=[None])
+
+def run_audit(file_bytes, cache=None, rules=None, model=None, name=None, db_name=None):
+    """
+    Run deductions and anomaly detection for an uploaded claims file.
+
+    Results are cached on (sha256 of the file, rules version, model id), so
+    reruns of the same upload against unchanged rules are returned without
+    re-reading.
+    rules: RulesSnapshot to audit against; the shared snapshot by default.
+    model: AnomalyModel to score with; None fits one on the file.
+    The result's timings are the per-stage records of the run (AuditTrace).
+    Each computed result is also recorded in the dashboard cube of db_name,
+    under the file's sha256 and name.
+    """
+    rules = rules or shared_rules().get()
+    digest = file_digest(file_bytes)
+    key = (digest, rules.version, model.model_id if model else None)
+    if cache is not None:
+        result = cache.get(key)
+        if result is not None:
+            log.info(json.dumps({'event': 'audit_cache_hit', 'file': digest[:12]}))
+            return result
+
+    trace = AuditTrace(file=digest[:12], rules_version=rules.version, model=key[2])
+    with trace.activate():
+        with trace.stage('load_claims') as record:
+            data_df = load_claims_cached(file_bytes, digest=digest)
+            record['rows'] = len(data_df)
+        with trace.stage('apply_deductions', len(data_df)):
+            deductions_df = apply_deductions(data_df, plan=rules.plan)
+        with trace.stage('detect_fraud_with_isolation', len(data_df)):
+            anomaly_df = detect_fraud_with_isolation(data_df, model=model)
+        record_audit_cube(digest, data_df, deductions_df, anomaly_df, name=name, rules_version=rules.version,
+                          db_name=db_name)
+    result = AuditResult(deductions_df, anomaly_df, key, trace.records)
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+# ------------------- مكعب الإحصاءات للوحة المتابعة -------------------
+CUBE_DIMENSIONS = ['provider', 'service', 'month']
+CUBE_MEASURES = ['claims', 'claimed', 'deductions', 'deducted', 'anomalies']
+
+def _month_labels(values):
+    return pd.to_datetime(pd.Index(values), errors='coerce').strftime('%Y-%m').fillna('')
+
+def _cube_labels(values, labels=None):
+    """Categorical of labels computed once per distinct value ('' when missing)"""
+    codes, uniques = pd.factorize(values)
+    uniques = labels(uniques) if labels is not None else uniques.astype(str)
+    # distinct values may share a label (two dates in one month)
+    categories, label_codes = np.unique(np.append(np.asarray(uniques, dtype=object), ''), return_inverse=True)
+    return pd.Categorical.from_codes(label_codes[codes], categories)
+
+def _cube_part(df, count_name, amount_column=None, amount_name=None):
+    if df is None or df.empty:
+        return None
+    no_value = pd.Series('', index=df.index)
+    part = pd.DataFrame({
+        'provider': _cube_labels(df.get('PROVIDER', no_value)),
+        'service': _cube_labels(df.get('SERVICE', no_value)),
+        'month': _cube_labels(df.get('TRX DATE', no_value), _month_labels),
+        count_name: 1,
+    })
+    if amount_name is not None:
+        part[amount_name] = pd.to_numeric(df.get(amount_column, no_value), errors='coerce').fillna(0).to_numpy()
+    return part.groupby(CUBE_DIMENSIONS, sort=False, observed=True).sum()
+
+def build_audit_cube(data_df, deductions_df=None, anomaly_df=None):
+    """
+    Claims, claimed amount, deductions, deducted amount and anomalies of one
+    audit per (provider, service, month). PROVIDER is an optional claims
+    column; without it every row has provider ''.
+    """
+    parts = [part for part in (
+        _cube_part(data_df, 'claims', 'PROV NET CLAIMED', 'claimed'),
+        _cube_part(deductions_df, 'deductions', 'PROV_NET_CLAIMED', 'deducted'),
+        _cube_part(anomaly_df, 'anomalies'),
+    ) if part is not None]
+    if not parts:
+        return pd.DataFrame(columns=CUBE_DIMENSIONS + CUBE_MEASURES)
+    cube = pd.concat(parts, axis=1).fillna(0).reset_index()
+    cube = cube.reindex(columns=CUBE_DIMENSIONS + CUBE_MEASURES, fill_value=0)
+    for column in CUBE_DIMENSIONS:
+        cube[column] = cube[column].astype(str)
+    for column in ('claims', 'deductions', 'anomalies'):
+        cube[column] = cube[column].astype('int64')
+    return cube
+
+def store_audit_cube(cube, file_id, name=None, rules_version=None, claims=None, db_name=None):
+    """Store an audit's cube in place of any earlier cube of the same file (e.g. before a rules change)"""
+    init_db(db_name)
+    conn = get_connection(db_name)
+    columns = ['file'] + CUBE_DIMENSIONS + CUBE_MEASURES
+    rows = ((file_id,) + row for row in cube[CUBE_DIMENSIONS + CUBE_MEASURES].itertuples(index=False, name=None))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM audit_cube WHERE file = ?", (file_id,))
+        conn.executemany(f"INSERT INTO audit_cube ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                         rows)
+        conn.execute('''INSERT OR REPLACE INTO audit_files (file, name, audited_at, rules_version, claims)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     (file_id, name, pd.Timestamp.now().isoformat(timespec='seconds'), rules_version, claims))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def record_audit_cube(file_id, data_df, deductions_df, anomaly_df, name=None, rules_version=None, db_name=None):
+    """Build and store the cube of one audit; returns the cube"""
+    with stage('audit_cube', len(data_df)) as record:
+        cube = build_audit_cube(data_df, deductions_df, anomaly_df)
+        store_audit_cube(cube, file_id, name=name, rules_version=rules_version, claims=len(data_df), db_name=db_name)
+        record['rows'] = len(cube)
+    return cube
+
+def query_audit_cube(by=(), providers=None, services=None, months=None, files=None, db_name=None):
+    """
+    Cube measures summed over the audited files, grouped by the CUBE_DIMENSIONS
+    in by (one total row when empty). providers / services / files restrict to
+    those values, months to an inclusive ('YYYY-MM', 'YYYY-MM') range.
+    """
+    by = list(by)
+    unknown = [d for d in by if d not in CUBE_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"unknown cube dimensions: {', '.join(unknown)}")
+    where, params = [], []
+    for column, values in (('provider', providers), ('service', services), ('file', files)):
+        if values:
+            where.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params += list(values)
+    if months:
+        where.append("month BETWEEN ? AND ?")
+        params += list(months)
+    query = f'''SELECT {''.join(d + ', ' for d in by)}
+                       {', '.join(f'coalesce(sum({m}), 0) AS {m}' for m in CUBE_MEASURES)}
+                FROM audit_cube'''
+    if where:
+        query += f" WHERE {' AND '.join(where)}"
+    if by:
+        query += f" GROUP BY {', '.join(by)} ORDER BY {', '.join(by)}"
+    try:
+        return pd.read_sql(query, get_connection(db_name), params=params)
+    except Exception:
+        return pd.DataFrame(columns=by + CUBE_MEASURES)
+
+def audit_files(db_name=None):
+    """The audited files recorded in the cube, newest first"""
+    try:
+        return pd.read_sql("SELECT * FROM audit_files ORDER BY audited_at DESC", get_connection(db_name))
+    except Exception:
+        return pd.DataFrame(columns=['file', 'name', 'audited_at', 'rules_version', 'claims'])
+
+# ------------------- تصفح النتائج من جهة الخادم -------------------
+RESULT_PAGE_SIZES = (25, 50, 100, 500)
+# result frames whose ResultView is kept by the app
+RESULT_VIEW_CACHE_SIZE = 8
+# (search, filters, sort) row orders kept per view, so paging only slices
+RESULT_VIEW_QUERIES = 8
+# columns with more distinct values than this get no value list in the
+# filter; they are matched by the text search or, if numeric, a range
+RESULT_FILTER_MAX_VALUES = 50
+
+def _codes_matching(codes, matched):
+    """Row mask from a per-distinct-value mask; missing values (code -1) never match"""
+    return np.append(np.asarray(matched, dtype=bool), False)[codes]
+
+class ResultView:
+    """
+    Server-side browsing of a result frame: search, filters and sort run
+    here and only the requested page is returned, so a million-row result
+    is never sent to the browser. Each column is factorized once, on first
+    use, and matching is done on its distinct values.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self._factors = {}
+        self._queries = LRUCache(RESULT_VIEW_QUERIES)
+
+    def __len__(self):
+        return len(self.df)
+
+    def _factorize(self, column):
+        """(codes, distinct values, distinct values as text) of a column"""
+        factors = self._factors.get(column)
+        if factors is None:
+            codes, uniques = pd.factorize(self.df[column])
+            if len(uniques) < np.iinfo(np.int32).max:
+                codes = codes.astype(np.int32)
+            factors = self._factors[column] = (codes, uniques, pd.Index(uniques).astype(str))
+        return factors
+
+    def options(self, column):
+        """
+        Distinct values of a column as text, for filter choices; None when
+        there are more than RESULT_FILTER_MAX_VALUES of them.
+        """
+        labels = self._factorize(column)[2]
+        return sorted(labels) if len(labels) <= RESULT_FILTER_MAX_VALUES else None
+
+    def bounds(self, column):
+        """(min, max) of a numeric column, for a range filter; None otherwise"""
+        values = self.df[column]
+        if not pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values) or values.isna().all():
+            return None
+        uniques = self._factorize(column)[1]
+        return uniques.min(), uniques.max()
+
+    def rows(self, search='', filters=None, sort_by=None, ascending=True, ranges=None):
+        """
+        Positions of the rows matching search (case-insensitive text in any
+        column), filters ({column: values as text}) and ranges ({column:
+        (low, high)}, inclusive), in sort_by order; missing values sort last.
+        """
+        filters = tuple(sorted((column, tuple(values)) for column, values in (filters or {}).items() if values))
+        ranges = tuple(sorted((ranges or {}).items()))
+        key = (search, filters, ranges, sort_by, ascending)
+        rows = self._queries.get(key)
+        if rows is None:
+            rows = np.flatnonzero(self._mask(search, filters, ranges))
+            if sort_by is not None:
+                rows = rows[np.argsort(self._sort_keys(sort_by, ascending)[rows], kind='stable')]
+            self._queries.put(key, rows)
+        return rows
+
+    def _mask(self, search, filters, ranges=()):
+        mask = np.ones(len(self.df), dtype=bool)
+        for column, values in filters:
+            codes, _, labels = self._factorize(column)
+            mask &= _codes_matching(codes, labels.isin(values))
+        for column, (low, high) in ranges:
+            codes, uniques, _ = self._factorize(column)
+            mask &= _codes_matching(codes, (uniques >= low) & (uniques <= high))
+        if search:
+            found = np.zeros(len(self.df), dtype=bool)
+            for column in self.df.columns:
+                codes, _, labels = self._factorize(column)
+                found |= _codes_matching(codes, labels.str.contains(search, case=False, regex=False))
+            mask &= found
+        return mask
+
+    def _sort_keys(self, column, ascending):
+        """Integer rank of every row's value; sorting ranks the distinct values only"""
+        codes, uniques, labels = self._factorize(column)
+        try:
+            order = pd.Index(uniques).argsort()
+        except TypeError:
+            # mixed types in one column: sort them as text
+            order = labels.argsort()
+        if not ascending:
+            order = order[::-1]
+        ranks = np.empty(len(uniques) + 1, dtype=np.int64)
+        ranks[order] = np.arange(len(uniques))
+        ranks[-1] = len(uniques)
+        return ranks[codes]
+
+    def page(self, rows, number, size):
+        """Rows of page number (from 0) of size rows, in the order of rows"""
+        return self.df.iloc[rows[number * size:(number + 1) * size]]
+
+# ------------------- تصدير النتائج -------------------
+# rows converted to Python values at a time when writing workbooks
+EXPORT_CHUNK_ROWS = 10_000
+EXCEL_MAX_ROWS = 1_048_576
+
+def write_csv(df, target):
+    """Write df as CSV to a path or binary file; utf-8-sig so Excel shows the Arabic text"""
+    df.to_csv(target, index=False, encoding='utf-8-sig', chunksize=EXPORT_CHUNK_ROWS)
+
+def write_excel(target, sheets):
+    """
+    Write (sheet name, DataFrame) pairs to one .xlsx workbook at target (a
+    path or binary file). The workbook is written in XlsxWriter's
+    constant-memory mode, row by row, so only EXPORT_CHUNK_ROWS rows are
+    ever held as Python values.
+    """
+    workbook = xlsxwriter.Workbook(target, {'constant_memory': True,
+                                            'default_date_format': 'yyyy-mm-dd'})
+    try:
+        for sheet_name, df in sheets:
+            if len(df) >= EXCEL_MAX_ROWS:
+                raise ValueError(f'{sheet_name} has {len(df)} rows, more than an Excel sheet can hold')
+            worksheet = workbook.add_worksheet(sheet_name[:31])
+            worksheet.write_row(0, 0, [str(c) for c in df.columns])
+            row = 1
+            for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+                chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS].astype(object)
+                for values in chunk.where(chunk.notna(), None).itertuples(index=False, name=None):
+                    worksheet.write_row(row, 0, values)
+                    row += 1
+    finally:
+        workbook.close()
+
+REPORT_FORMATS = ('xlsx', 'csv', 'parquet')
+
+def report_summary(result):
+    """Claims and amounts per deducted service and per risk level, with totals"""
+    rows = []
+    deductions_df = result.deductions
+    if not deductions_df.empty:
+        by_service = deductions_df.groupby('SERVICE', observed=True, dropna=False)['PROV_NET_CLAIMED'].agg(['size', 'sum'])
+        for service, claims, amount in by_service.itertuples(name=None):
+            rows.append(('Deductions', str(service), claims, amount))
+    rows.append(('Deductions', 'Total', len(deductions_df),
+                 deductions_df['PROV_NET_CLAIMED'].sum() if not deductions_df.empty else 0.0))
+
+    for level, tier in risk_tiers(result.anomalies):
+        rows.append(('Anomalies', level, len(tier), tier['PROV NET CLAIMED'].sum() if not tier.empty else 0.0))
+    anomaly_count = len(result.anomalies) if result.anomalies is not None else 0
+    anomaly_amount = result.anomalies['PROV NET CLAIMED'].sum() if anomaly_count else 0.0
+    rows.append(('Anomalies', 'Total', anomaly_count, anomaly_amount))
+
+    summary = pd.DataFrame(rows, columns=['SECTION', 'ITEM', 'CLAIMS', 'AMOUNT'])
+    summary['AMOUNT'] = summary['AMOUNT'].astype(float).round(2)
+    return summary
+
+def report_tables(result):
+    """(name, frame) for every table of the report bundle; the result frames are not copied"""
+    tables = [('Summary', report_summary(result)), ('Deductions', result.deductions)]
+    tables += [(level.title(), tier) for level, tier in risk_tiers(result.anomalies)]
+    return tables
+
+def write_report(target, result, fmt='xlsx'):
+    """
+    Write the whole audit result to target (a path or binary file) in one
+    pass: a workbook with one sheet per table for 'xlsx', otherwise a zip
+    holding one CSV or Parquet file per table.
+    """
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f'unknown report format: {fmt}')
+    tables = report_tables(result)
+    if fmt == 'xlsx':
+        write_excel(target, tables)
+        return
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name, df in tables:
+            with bundle.open(f"{name.lower().replace(' ', '_')}.{fmt}", 'w') as member:
+                if fmt == 'csv':
+                    write_csv(df, member)
+                else:
+                    df.to_parquet(member, index=False)
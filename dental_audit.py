@@ -1,15 +1,18 @@
 # app.py
 import streamlit as st
 import pandas as pd
-import sqlite3
 import hashlib
 import json
 import io
-import re
-import numpy as np
-from datetime import datetime, timedelta
-from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import IsolationForest
+import os
+import logging
+from datetime import datetime
+
+from audit_engine import (
+    AUDIT_CACHE_SIZE, EXPORT_CACHE_SIZE, init_db, shared_rules, shared_anomaly_model, LRUCache, run_audit,
+    load_claims_cached, write_csv, write_excel, write_report, risk_tiers, AuditTrace, audit_files, query_audit_cube,
+    ResultView, RESULT_PAGE_SIZES, RESULT_VIEW_CACHE_SIZE,
+)
 
 # ------------------- إعداد كلمات السر -------------------
 # Site-wide login: admin
@@ -19,9 +22,6 @@ ADMIN_PASSWORD_HASH = hashlib.md5("password".encode()).hexdigest()
 # Delete rules password: delete
 DELETE_PASSWORD_HASH = hashlib.md5("delete".encode()).hexdigest()
 
-# ------------------- إعداد قاعدة البيانات -------------------
-DB_NAME = "dental_rules.db"
-
 # ------------------- واجهة المستخدم و CSS/JS -------------------
 def setup_ui():
     st.set_page_config(
@@ -552,64 +552,160 @@ def setup_ui():
     """
 
 # ------------------- دالة لعرض الجداول بشكل DataTable تفاعلي -------------------
-def render_table(df: pd.DataFrame, table_name="data", export_buttons=True):
+# report format label -> (write_report format, file extension, mime type)
+REPORT_DOWNLOADS = {
+    "Excel workbook": ('xlsx', 'xlsx', "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "ZIP of CSV": ('csv', 'zip', "application/zip"),
+    "ZIP of Parquet": ('parquet', 'zip', "application/zip"),
+}
+
+@st.cache_resource
+def export_cache():
+    """Generated download files for the whole server, keyed by result version"""
+    return LRUCache(EXPORT_CACHE_SIZE)
+
+def lazy_export(writer, cache_key=None):
+    """
+    Callable for st.download_button: the file is only generated when the
+    button is clicked, and once per cache_key. Generation is logged as an
+    'export' stage.
+
+    writer: function writing the file to a binary buffer
     """
-    Provide download options for a pandas DataFrame.
+    cache = export_cache()  # resolved here: the callable runs outside the script thread
+
+    def build():
+        data = cache.get(cache_key) if cache_key is not None else None
+        if data is None:
+            buffer = io.BytesIO()
+            export = cache_key[1:] if cache_key is not None else None
+            with AuditTrace(export=export).stage('export') as record:
+                writer(buffer)
+                record['bytes'] = buffer.tell()
+            data = buffer.getvalue()
+            if cache_key is not None:
+                cache.put(cache_key, data)
+        return data
+    return build
+
+@st.cache_resource
+def result_views():
+    """ResultView of each displayed result frame, keyed by result version and table"""
+    return LRUCache(RESULT_VIEW_CACHE_SIZE)
+
+def result_view(df, table_name, cache_key=None):
+    if cache_key is None:
+        return ResultView(df)
+    views = result_views()
+    view = views.get((cache_key, table_name))
+    if view is None:
+        view = ResultView(df)
+        views.put((cache_key, table_name), view)
+    return view
+
+def browse_table(view, table_name):
+    """Search, filter, sort and page controls; only the current page is sent to the browser"""
+    columns = list(view.df.columns)
+    col1, col2, col3 = st.columns([2, 2, 1])
+    with col1:
+        search = st.text_input("🔍 Search", key=f"view_search_{table_name}")
+    with col2:
+        sort_by = st.selectbox("Sort by", [None] + columns, format_func=lambda c: c or "(file order)",
+                               key=f"view_sort_{table_name}")
+    with col3:
+        ascending = st.radio("Order", ["Ascending", "Descending"], key=f"view_order_{table_name}",
+                             disabled=sort_by is None) == "Ascending"
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        filter_column = st.selectbox("Filter column", [None] + columns, format_func=lambda c: c or "(none)",
+                                     key=f"view_filter_column_{table_name}")
+    with col2:
+        filter_values, filter_range = [], None
+        if filter_column is not None:
+            # value lists only for low-cardinality columns; the rest never leave the server
+            options = view.options(filter_column)
+            bounds = view.bounds(filter_column) if options is None else None
+            if options is not None:
+                filter_values = st.multiselect("Values", options,
+                                               key=f"view_filter_values_{table_name}_{filter_column}")
+            elif bounds is not None:
+                low, high = (float(b) for b in bounds)
+                col_from, col_to = st.columns(2)
+                with col_from:
+                    low = st.number_input("From", value=low, key=f"view_filter_from_{table_name}_{filter_column}")
+                with col_to:
+                    high = st.number_input("To", value=high, key=f"view_filter_to_{table_name}_{filter_column}")
+                filter_range = (low, high)
+            else:
+                st.caption("Too many distinct values to list; use the search box.")
+
+    rows = view.rows(search.strip(), {filter_column: filter_values} if filter_column else None, sort_by, ascending,
+                     {filter_column: filter_range} if filter_range else None)
+
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        page_size = st.selectbox("Rows per page", RESULT_PAGE_SIZES, index=1, key=f"view_page_size_{table_name}")
+    pages = max(1, -(-len(rows) // page_size))
+    # back to the first page whenever the rows change
+    query = (search, sort_by, ascending, filter_column, tuple(filter_values), filter_range, page_size)
+    page_key = f"view_page_{table_name}"
+    if st.session_state.get(f"view_query_{table_name}") != query or st.session_state.get(page_key, 1) > pages:
+        st.session_state[page_key] = 1
+    st.session_state[f"view_query_{table_name}"] = query
+    with col2:
+        page = st.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, step=1, key=page_key)
+
+    st.dataframe(view.page(rows, page - 1, page_size), hide_index=True)
+    first = (page - 1) * page_size
+    shown = f"Rows {first + 1:,}–{min(first + page_size, len(rows)):,} of {len(rows):,}" if len(rows) else "No matching rows"
+    if len(rows) < len(view):
+        shown += f" (filtered from {len(view):,})"
+    st.caption(shown)
+
+def render_table(df: pd.DataFrame, table_name="data", export_buttons=True, cache_key=None):
+    """
+    Browse a pandas DataFrame page by page and provide download options.
     
     Args:
-        df: Input DataFrame to download
+        df: Input DataFrame to show and download (not modified)
         table_name: Base name for downloaded files (default: "data")
         export_buttons: Whether to show export buttons (default: True)
+        cache_key: Version of the data (e.g. AuditResult.key); generated files and
+            search/sort results are reused while it is unchanged
     """
     if df is None or df.empty:
         st.info("No data available to download.")
         return
     
-    # Create a copy of the dataframe to avoid modifying the original
-    df2 = df.copy()
-    
-    st.write(f"### Download {table_name.replace('_', ' ').title()}")
-    
-    # Show basic info about the data
-    st.info(f"Data contains {len(df2)} rows .")
+    st.write(f"### {table_name.replace('_', ' ').title()}")
+    browse_table(result_view(df, table_name, cache_key), table_name)
+    if not export_buttons:
+        return
     
     # Create columns for download buttons
     col1, col2 = st.columns(2)
     
-    # Add download buttons
+    # Add download buttons; files are built on click
     with col1:
-        csv = df2.to_csv(index=False).encode('utf-8-sig')
         st.download_button(
             label="Download CSV",
-            data=csv,
+            data=lazy_export(lambda buffer: write_csv(df, buffer),
+                             (cache_key, table_name, 'csv') if cache_key is not None else None),
             file_name=f"{table_name}.csv",
-            mime="text/csv"
+            mime="text/csv",
+            key=f"csv_{table_name}"
         )
     with col2:
-        excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-            df2.to_excel(writer, index=False, sheet_name=table_name[:31])
-        excel_data = excel_buffer.getvalue()
         st.download_button(
             label="Download Excel",
-            data=excel_data,
+            data=lazy_export(lambda buffer: write_excel(buffer, [(table_name, df)]),
+                             (cache_key, table_name, 'xlsx') if cache_key is not None else None),
             file_name=f"{table_name}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key=f"xlsx_{table_name}"
         )
 
 # ------------------- الدوال الأساسية (من كودك الأصلي مع الحفاظ على المنطق) -------------------
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS rules
-                 (serv_cat text, tooth_number integer,
-                  min_patient_age integer, max_patient_age integer,
-                  new_cpt text, arabic_desc text, english_desc text,
-                  service_code text, tooth_type text, tooth_category text,
-                  service_category text, service_type text)''')
-    conn.commit()
-    conn.close()
-
 def authenticate_upload(password):
     return hashlib.md5(password.encode()).hexdigest() == ADMIN_PASSWORD_HASH
 
@@ -643,24 +739,7 @@ def upload_rules():
                 if authenticate_upload(pw or ""):
                     try:
                         rules_df = pd.read_csv(uploaded, encoding='utf-8-sig')
-                        # Rename expected columns if present
-                        rules_df.rename(columns={
-                            'SERV CAT': 'serv_cat',
-                            'TOOTH_NUMBER': 'tooth_number',
-                            'MIN_PATIENT_AGE': 'min_patient_age',
-                            'MAX_PATIENT_AGE': 'max_patient_age',
-                            'New CPT': 'new_cpt',
-                            'Arabic Description': 'arabic_desc',
-                            'English Description': 'english_desc',
-                            'SERVICE_CODE': 'service_code',
-                            'TOOTH_TYPE': 'tooth_type',
-                            'TOOTH_CATEGORY': 'tooth_category',
-                            'SERVICE_CATEGORY': 'service_category',
-                            'Service type': 'service_type'
-                        }, inplace=True)
-                        conn = sqlite3.connect(DB_NAME)
-                        rules_df.to_sql('rules', conn, if_exists='replace', index=False)
-                        conn.close()
+                        shared_rules().replace(rules_df)
                         st.success("✅ Rules uploaded successfully!")
                         st.session_state.rules_uploaded = True
                     except Exception as e:
@@ -668,18 +747,40 @@ def upload_rules():
                 else:
                     st.error("❌ Incorrect upload password.")
 
+    # قواعد الخصم (تكرار خلال مدة، حد الكمية، حدود العمر والسن)
+    with st.expander("📤 Upload Deduction Rules (CSV)"):
+        uploaded_deductions = st.file_uploader("Select the deduction rules file. (CSV) ", type=["csv"],
+                                               key="deduction_rules_uploader")
+        st.caption("Columns: RULE_ID, KIND (repeat_within_days, quantity_cap, frequency_limit, age_tooth_bounds, "
+                   "duplicate_claims), SERVICE, "
+                   "DESCRIPTION, WINDOW_DAYS, MAX_QUANTITY, PERIOD (year, month), TOOTH_FROM, TOOTH_TO, "
+                   "MIN_AGE, MAX_AGE, REASON, ENABLED. The file replaces all deduction rules; an "
+                   "age_tooth_bounds rule without bounds uses the rules table above.")
+
+        if uploaded_deductions is not None:
+            pw = st.text_input("Enter upload password:", type="password", key="pw_upload_deductions")
+            if st.button("Upload Deduction Rules", key="btn_upload_deductions"):
+                if authenticate_upload(pw or ""):
+                    try:
+                        shared_rules().replace_deduction_rules(pd.read_csv(uploaded_deductions, encoding='utf-8-sig'))
+                        st.success("✅ Deduction rules uploaded successfully!")
+                    except Exception as e:
+                        st.error(f"❌ An error occurred while uploading the file.: {e}")
+                else:
+                    st.error("❌ Incorrect upload password.")
+
     # عرض القواعد وحذفها
-    conn = sqlite3.connect(DB_NAME)
-    try:
-        rules_df = pd.read_sql("SELECT * FROM rules", conn)
-    except Exception:
-        rules_df = pd.DataFrame()
-    conn.close()
+    rules = shared_rules().get()
+    rules_df = rules.rules
+
+    st.markdown("---")
+    st.markdown("### 📐 Deduction Rules")
+    render_table(rules.deduction_rules, table_name="deduction_rules", cache_key=('deduction_rules', rules.version))
 
     if not rules_df.empty:
         st.markdown("---")
         st.markdown("### 📋 Current Rules")
-        render_table(rules_df, table_name="rules")
+        render_table(rules_df, table_name="rules", cache_key=('rules', rules.version))
 
         st.markdown("---")
         if st.button("🗑️ Show Delete Rules Form"):
@@ -693,11 +794,7 @@ def upload_rules():
                 if submitted:
                     if authenticate_delete(dpw or ""):
                         try:
-                            conn = sqlite3.connect(DB_NAME)
-                            c = conn.cursor()
-                            c.execute("DELETE FROM rules")
-                            conn.commit()
-                            conn.close()
+                            shared_rules().delete()
                             st.success("✅ Rules deleted successfully.")
                             st.session_state.rules_uploaded = False
                             st.session_state.show_delete_form = False
@@ -709,217 +806,32 @@ def upload_rules():
     else:
         st.info("No rules are currently stored.")
 
-# ------------------- دوال تطبيق الخصومات وكشف الشذوذ (من كودك الأصلي) -------------------
-def apply_deductions(data_df):
-    """Apply deductions based on rules"""
-    conn = sqlite3.connect(DB_NAME)
-    try:
-        rules_df = pd.read_sql("SELECT * FROM rules", conn)
-    except Exception:
-        rules_df = pd.DataFrame()
-    conn.close()
-
-    non_compliant_cases = []
-    processed_pairs = set()
-    gum_surgery_records = {}
-    ioe_records = {}
-
-    # Ensure TRX DATE present for sorting
-    if 'TRX DATE' in data_df.columns:
-        data_df = data_df.sort_values('TRX DATE')
-    else:
-        data_df = data_df.copy()
-
-    for index, row in data_df.iterrows():
-        service = row.get('SERVICE', '')
-        adherent = row.get('ADHERENT#', '')
-        trx_date = row.get('TRX DATE') if pd.notna(row.get('TRX DATE')) else None
-        prov_net_claimed = float(row.get('PROV NET CLAIMED')) if pd.notna(row.get('PROV NET CLAIMED')) else 0
-        prov_desc = str(row.get('PROV ITEM DESC MAPPING', ''))
-        age = int(row.get('AGE')) if pd.notna(row.get('AGE')) else 0
-        tooth_num = row.get('EXTRACTED_TOOTH')
-        quantity = int(row.get('QTYAPP')) if pd.notna(row.get('QTYAPP')) and row.get('QTYAPP') != 0 else 1
-
-        # Rule 1: IOE repeat less than 30 days
-        if service == 'IOE' and trx_date is not None:
-            if adherent in ioe_records:
-                last_date, _ = ioe_records[adherent]
-                if (trx_date - last_date) < timedelta(days=30):
-                    non_compliant_cases.append({
-                        'SSNBR': row.get('SSNBR', ''),
-                        'ADHERENT#': adherent,
-                        'SERVICE': service,
-                        'GM_ITEM_DESCRIPTION': row.get('GM ITEM DESCRIPTION', ''),
-                        'PROV_ITEM_DESC': prov_desc,
-                        'TOOTH_NUMBER': tooth_num,
-                        'PATIENT_AGE': age,
-                        'TRX DATE': trx_date.strftime('%Y-%m-%d') if trx_date else '',
-                        'PREVIOUS_DATE': last_date.strftime('%Y-%m-%d') if last_date else '',
-                        'PROV_NET_CLAIMED': prov_net_claimed,
-                        'QTYAPP': quantity,
-                        'REASON': 'Follow-up'
-                    })
-            ioe_records[adherent] = (trx_date, index)
-
-        # Rule 2: specific gum surgery limit
-        if 'جراحة اللثة الصديدية' in prov_desc:
-            if adherent in gum_surgery_records:
-                gum_surgery_records[adherent]['total_qty'] += quantity
-                total_qty = gum_surgery_records[adherent]['total_qty']
-                if total_qty > 2:
-                    excess_qty = min(total_qty - 2, quantity)
-                    amount_to_deduct = (prov_net_claimed / quantity) * excess_qty if quantity != 0 else 0
-                    non_compliant_cases.append({
-                        'SSNBR': row.get('SSNBR', ''),
-                        'ADHERENT#': adherent,
-                        'SERVICE': service,
-                        'GM_ITEM_DESCRIPTION': row.get('GM ITEM DESCRIPTION', ''),
-                        'PROV_ITEM_DESC': prov_desc,
-                        'TOOTH_NUMBER': tooth_num,
-                        'PATIENT_AGE': age,
-                        'TRX DATE': trx_date.strftime('%Y-%m-%d') if trx_date else '',
-                        'TOTAL_QUANTITY': total_qty,
-                        'EXCESS_QUANTITY': excess_qty,
-                        'PROV_NET_CLAIMED': amount_to_deduct,
-                        'QTYAPP': quantity,
-                        'REASON': f'تجاوز حد جراحة اللثة (الحد الأقصى 2، الكمية الإجمالية {total_qty})'
-                    })
-            else:
-                gum_surgery_records[adherent] = {'total_qty': quantity}
-
-        # Rule 3: age mismatch (requires rules)
-        if pd.isna(tooth_num) or tooth_num is None:
-            continue
-        case_id = (row.get('SSNBR',''), adherent, service, tooth_num)
-        if case_id in processed_pairs:
-            continue
-
-        if not rules_df.empty:
-            matching_rules = rules_df[
-                (rules_df['serv_cat'] == service) &
-                (rules_df['tooth_number'] == tooth_num)
-            ]
-            if not matching_rules.empty:
-                rule = matching_rules.iloc[0]
-                min_age = int(rule['min_patient_age']) if pd.notna(rule.get('min_patient_age')) else 0
-                max_age = int(rule['max_patient_age']) if pd.notna(rule.get('max_patient_age')) else 120
-                if age < min_age or age > max_age:
-                    non_compliant_cases.append({
-                        'SSNBR': row.get('SSNBR',''),
-                        'ADHERENT#': adherent,
-                        'SERVICE': service,
-                        'GM_ITEM_DESCRIPTION': row.get('GM ITEM DESCRIPTION',''),
-                        'TOOTH_NUMBER': tooth_num,
-                        'PATIENT_AGE': age,
-                        'TRX DATE': trx_date.strftime('%Y-%m-%d') if trx_date else '',
-                        'PROV_NET_CLAIMED': prov_net_claimed,
-                        'QTYAPP': quantity,
-                        'REASON': f'incompatible age'
-                    })
-                    processed_pairs.add(case_id)
-
-    return pd.DataFrame(non_compliant_cases) if non_compliant_cases else pd.DataFrame()
-
-def detect_fraud_with_isolation(data_df):
-    """Detect anomalies using Isolation Forest"""
-    if data_df is None or data_df.empty:
-        return pd.DataFrame()
-
-    excluded_services = ['XRD', 'IOE', 'CL']
-    if 'SERVICE' not in data_df.columns:
-        return pd.DataFrame()
-    filtered_df = data_df[~data_df['SERVICE'].isin(excluded_services)].copy()
-    if filtered_df.empty:
-        return pd.DataFrame()
-
-    # aggregate per adherent
-    service_counts = filtered_df.groupby('ADHERENT#')['SERVICE'].count().reset_index()
-    service_counts.columns = ['ADHERENT#', 'SERVICE_COUNT']
-    cost_totals = filtered_df.groupby('ADHERENT#')['PROV NET CLAIMED'].sum().reset_index()
-    cost_totals.columns = ['ADHERENT#', 'TOTAL_COST']
-
-    merged_df = pd.merge(filtered_df, service_counts, on='ADHERENT#')
-    merged_df = pd.merge(merged_df, cost_totals, on='ADHERENT#')
-
-    # Features
-    features = merged_df[['PROV NET CLAIMED', 'QTYAPP', 'SERVICE_COUNT', 'TOTAL_COST']].copy()
-    # compute days since last
-    if 'TRX DATE' in merged_df.columns:
-        features['DAYS_SINCE_LAST'] = merged_df.groupby('ADHERENT#')['TRX DATE'].diff().dt.days.fillna(0)
-    else:
-        features['DAYS_SINCE_LAST'] = 0
-
-    scaler = StandardScaler()
-    X = scaler.fit_transform(features)
-
-    clf = IsolationForest(contamination=0.1, random_state=42)
-    predictions = clf.fit_predict(X)
-
-    merged_df['ANOMALY_SCORE'] = -clf.decision_function(X)
-    merged_df['IS_FRAUD'] = predictions == -1
-
-    result_df = merged_df[merged_df['IS_FRAUD']].copy()
-    if result_df.empty:
-        return pd.DataFrame()
-
-    # Risk level
-    conditions = [
-        (result_df['TOTAL_COST'] > result_df['TOTAL_COST'].quantile(0.9)) &
-        (result_df['SERVICE_COUNT'] > result_df['SERVICE_COUNT'].quantile(0.9)),
-        (result_df['TOTAL_COST'] > result_df['TOTAL_COST'].quantile(0.75)) |
-        (result_df['SERVICE_COUNT'] > result_df['SERVICE_COUNT'].quantile(0.75))
-    ]
-    choices = ['high risk', 'medium risk']
-    result_df['RISK_LEVEL'] = np.select(conditions, choices, default='low risk')
-
-    columns_to_export = [
-        'SSNBR', 'ADHERENT#', 'SERVICE', 'GM ITEM DESCRIPTION',
-        'PROV ITEM DESC MAPPING', 'TRX DATE', 'PROV NET CLAIMED',
-        'QTYAPP', 'SERVICE_COUNT', 'TOTAL_COST', 'ANOMALY_SCORE', 'RISK_LEVEL'
-    ]
-    # Keep only columns that exist
-    columns_to_export = [c for c in columns_to_export if c in result_df.columns]
-    result_df = result_df[columns_to_export]
-
-    # Format
-    if 'TRX DATE' in result_df.columns:
-        try:
-            result_df['TRX DATE'] = pd.to_datetime(result_df['TRX DATE']).dt.strftime('%Y-%m-%d')
-        except Exception:
-            pass
-    if 'PROV NET CLAIMED' in result_df.columns:
-        result_df['PROV NET CLAIMED'] = result_df['PROV NET CLAIMED'].round(2)
-    if 'TOTAL_COST' in result_df.columns:
-        result_df['TOTAL_COST'] = result_df['TOTAL_COST'].round(2)
-    if 'ANOMALY_SCORE' in result_df.columns:
-        result_df['ANOMALY_SCORE'] = result_df['ANOMALY_SCORE'].round(4)
-
-    # Sort by risk
-    order_map = {'high risk': 0, 'medium risk': 1, 'low risk': 2}
-    result_df['R_ORDER'] = result_df['RISK_LEVEL'].map(order_map).fillna(3)
-    result_df = result_df.sort_values(['R_ORDER', 'ANOMALY_SCORE']).drop(columns=['R_ORDER'])
-
-    return result_df
-
-def export_to_csv_with_arabic(df):
-    output = io.StringIO()
-    df.to_csv(output, index=False, encoding='utf-8-sig')
-    output.seek(0)
-    return output.getvalue().encode('utf-8-sig')
+def render_timings(timings):
+    """Collapsible table of the per-stage timings of an audit"""
+    if not timings:
+        return
+    with st.expander("⏱️ Performance"):
+        table = pd.DataFrame(timings)
+        # nested stages are indented under the stage they ran in
+        table['stage'] = ['\u2003' * depth + name for depth, name in zip(table['depth'], table['stage'])]
+        columns = [c for c in ('stage', 'rows', 'seconds', 'rows_per_second', 'peak_mb') if c in table.columns]
+        st.dataframe(table[columns], hide_index=True)
+        st.caption("Timings of the run that produced these results (reruns of the same file are served from cache). "
+                   "Peak memory is the growth of the process's resident memory during the stage.")
+
+@st.cache_resource
+def audit_cache():
+    """One result cache for the whole server, surviving script reruns"""
+    return LRUCache(AUDIT_CACHE_SIZE)
 
 # ------------------- Data Processing (User Interface) -------------------
 def process_data():
     st.markdown('<div class="data-header"><h2>🦷 Dental Data Processing and Risk Assessment</h2><p>Upload the data file, then apply rules and detect anomalies</p></div>', unsafe_allow_html=True)
 
     # Check rules exist
-    conn = sqlite3.connect(DB_NAME)
-    try:
-        rules_count = pd.read_sql("SELECT COUNT(*) FROM rules", conn).iloc[0,0]
-    except Exception:
-        rules_count = 0
-    conn.close()
-
-    if rules_count == 0:
+    rules = shared_rules().get()
+
+    if rules.rules.empty:
         st.error("⚠️ No rules have been uploaded yet. Please go to the 'Upload Rules' page to upload rules.")
         return
 
@@ -928,40 +840,27 @@ def process_data():
 
     if data_file:
         try:
-            data_df = pd.read_csv(data_file, encoding='utf-8-sig')
-            # ensure date parsing
-            if 'TRX DATE' in data_df.columns:
-                data_df['TRX DATE'] = pd.to_datetime(data_df['TRX DATE'], errors='coerce')
-            data_df['QTYAPP'] = pd.to_numeric(data_df.get('QTYAPP', 1), errors='coerce').fillna(1)
-
-            # extract tooth number heuristic if missing
-            def extract_tooth_number(description):
-                if pd.isna(description): return None
-                patterns = [r'tooth[\s\-_]?(\d+)', r't[\s\-_]?(\d+)', r'\b(\d{1,2})\b', r'\((\d{1,2})\)']
-                for pattern in patterns:
-                    match = re.search(pattern, str(description), re.IGNORECASE)
-                    if match:
-                        try:
-                            return int(match.group(1))
-                        except:
-                            return None
-                return None
-
-            data_df['EXTRACTED_TOOTH'] = data_df.get('GM ITEM DESCRIPTION', '').apply(extract_tooth_number)
+            with st.spinner("Analyzing data, applying rules and detecting anomalies..."):
+                model = shared_anomaly_model().get()
+                if shared_anomaly_model().unusable:
+                    st.warning("⚠️ The stored anomaly model cannot be loaded (another scikit-learn version, or "
+                               "damaged) and is not used; this file is scored on its own. Retrain the model to "
+                               "restore comparable scores.")
+                result = run_audit(data_file.getvalue(), cache=audit_cache(), rules=rules, model=model,
+                                   name=data_file.name)
+            deductions_df = result.deductions
+            render_timings(result.timings)
 
             # ------ Apply Deductions ------
             st.markdown("---")
             st.markdown('<div class="data-header"><h2>💰 Deductions and Rule Application</h2></div>', unsafe_allow_html=True)
 
-            with st.spinner("Analyzing data and applying rules..."):
-                deductions_df = apply_deductions(data_df)
-
             if not deductions_df.empty:
                 st.success(f"✅ It was discovered {len(deductions_df)} Condition requiring deductions")
-                render_table(deductions_df, table_name="deductions")
+                render_table(deductions_df, table_name="deductions", cache_key=result.key)
                 total_deduction = deductions_df['PROV_NET_CLAIMED'].sum() if 'PROV_NET_CLAIMED' in deductions_df.columns else 0
                 st.warning(f"💸 Total potential deduction amount: **{total_deduction:,.2f}   EGP**")
-                csv_data = export_to_csv_with_arabic(deductions_df)
+                csv_data = lazy_export(lambda buffer: write_csv(deductions_df, buffer), (result.key, 'deductions', 'csv'))
                 st.download_button("📥 Download Deductions File", data=csv_data, file_name="Dental_Deductions.csv", mime="text/csv")
             else:
                 st.info("🎉 There are no situations that warrant a deduction based on the rules.")
@@ -970,34 +869,113 @@ def process_data():
             st.markdown("---")
             st.markdown('<div class="data-header"><h2>🔎 Anomaly Detection</h2></div>', unsafe_allow_html=True)
 
-            with st.spinner("Analyzing anomalies..."):
-                anomaly_df = detect_fraud_with_isolation(data_df)
+            anomaly_df = result.anomalies
+
+            with st.expander("🧠 Anomaly Model"):
+                if model is not None:
+                    st.caption(f"Scored with the baseline model trained on {model.trained_on or 'an earlier file'} "
+                               f"({model.claims} claims, {model.trained_at}).")
+                else:
+                    st.caption("No baseline model yet: the model was fitted on this file, "
+                               "so its scores can't be compared with other files.")
+                mpw = st.text_input("Enter upload password:", type="password", key="pw_model")
+                if st.button("Train model on this file", key="btn_train_model"):
+                    if authenticate_upload(mpw or ""):
+                        with st.spinner("Training the anomaly model..."):
+                            shared_anomaly_model().train(load_claims_cached(data_file.getvalue()),
+                                                         trained_on=data_file.name)
+                        st.success("✅ Baseline model trained; new files are scored against it.")
+                        st.rerun()
+                    else:
+                        st.error("❌ Incorrect upload password.")
 
             if not anomaly_df.empty:
                 st.success(f"✅ It was discovered {len(anomaly_df)} anomalies")
                 # Show by risk level
-                high = anomaly_df[anomaly_df.get('RISK_LEVEL') == 'High Risk']
-                med = anomaly_df[anomaly_df.get('RISK_LEVEL') == 'Medium Risk']
-                low = anomaly_df[anomaly_df.get('RISK_LEVEL') == 'Low Risk']
+                (_, high), (_, med), (_, low) = risk_tiers(anomaly_df)
 
                 if not high.empty:
                     st.subheader("🔴 High Risk")
-                    render_table(high, table_name="high_risk")
+                    render_table(high, table_name="high_risk", cache_key=result.key)
                 if not med.empty:
                     st.subheader("🟠 Medium Risk")
-                    render_table(med, table_name="medium_risk")
+                    render_table(med, table_name="medium_risk", cache_key=result.key)
                 if not low.empty:
                     st.subheader("🟢 Low Risk")
-                    render_table(low, table_name="low_risk")
+                    render_table(low, table_name="low_risk", cache_key=result.key)
 
-                csv_data = export_to_csv_with_arabic(anomaly_df)
+                csv_data = lazy_export(lambda buffer: write_csv(anomaly_df, buffer), (result.key, 'anomalies', 'csv'))
                 st.download_button("📥 Download Anomaly Detection Results", data=csv_data, file_name="Anomaly_Detection.csv", mime="text/csv")
             else:
                 st.info("🎉 There are no anomalies after excluding the specified services.")
 
+            # ------ Full Report ------
+            st.markdown("---")
+            st.markdown('<div class="data-header"><h2>📦 Full Audit Report</h2><p>Summary, deductions and every risk level in one file</p></div>', unsafe_allow_html=True)
+            report_format = st.selectbox("Report format", list(REPORT_DOWNLOADS), key="report_format")
+            fmt, extension, mime = REPORT_DOWNLOADS[report_format]
+            st.download_button(
+                "📥 Download Full Report",
+                data=lazy_export(lambda buffer: write_report(buffer, result, fmt), (result.key, 'report', fmt)),
+                file_name=f"Dental_Audit_Report.{extension}",
+                mime=mime,
+                key="btn_report"
+            )
+
         except Exception as e:
             st.error(f"❌ An error occurred during processing: {e}")
 
+# ------------------- لوحة المتابعة (من مكعب الإحصاءات) -------------------
+def dashboard():
+    """Totals of every recorded audit, read from the cube in the rules database"""
+    st.markdown('<div class="data-header"><h2>📊 Audit Dashboard</h2><p>Spend, deductions and anomalies by provider, service and month</p></div>', unsafe_allow_html=True)
+
+    files = audit_files()
+    if files.empty:
+        st.info("No audits have been recorded yet. Process a data file first.")
+        return
+
+    # filter choices come from the cube itself, never from the claims
+    file_names = dict(zip(files['file'], files['name'].fillna(files['file'].str[:12])))
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        chosen_files = st.multiselect("Files", list(file_names), format_func=file_names.get, key="dash_files")
+    with col2:
+        providers = st.multiselect("Providers", query_audit_cube(by=['provider'])['provider'].tolist(),
+                                   format_func=lambda v: v or "(not in file)", key="dash_providers")
+    with col3:
+        services = st.multiselect("Services", query_audit_cube(by=['service'])['service'].tolist(),
+                                  format_func=lambda v: v or "(none)", key="dash_services")
+    months = [m for m in query_audit_cube(by=['month'])['month'] if m]
+    month_range = None
+    if len(months) > 1:
+        chosen = st.select_slider("Months", options=months, value=(months[0], months[-1]), key="dash_months")
+        # the full range also keeps claims without a date
+        if chosen != (months[0], months[-1]):
+            month_range = chosen
+    filters = dict(providers=providers, services=services, months=month_range, files=chosen_files)
+
+    totals = query_audit_cube(**filters).iloc[0]
+    metrics = st.columns(5)
+    metrics[0].metric("Claims", f"{int(totals['claims']):,}")
+    metrics[1].metric("Claimed (EGP)", f"{totals['claimed']:,.2f}")
+    metrics[2].metric("Deductions", f"{int(totals['deductions']):,}")
+    metrics[3].metric("Deducted (EGP)", f"{totals['deducted']:,.2f}")
+    metrics[4].metric("Anomalies", f"{int(totals['anomalies']):,}")
+
+    st.markdown("### 📈 By Month")
+    by_month = query_audit_cube(by=['month'], **filters)
+    by_month['month'] = by_month['month'].replace('', '(no date)')
+    st.bar_chart(by_month.set_index('month')[['claimed', 'deducted']])
+
+    tab_provider, tab_service = st.tabs(["🏥 By Provider", "🦷 By Service"])
+    for tab, dimension in ((tab_provider, 'provider'), (tab_service, 'service')):
+        with tab:
+            table = query_audit_cube(by=[dimension], **filters).sort_values('deducted', ascending=False)
+            table['deduction_rate'] = (table['deducted'] / table['claimed']).where(table['claimed'] > 0).round(4)
+            table[dimension] = table[dimension].replace('', '(not given)')
+            st.dataframe(table, hide_index=True)
+
 # ------------------- دالة التحقق من دخول الموقع -------------------
 def site_authentication():
     if 'site_authenticated' not in st.session_state:
@@ -1037,6 +1015,8 @@ def main():
             st.session_state.page = "upload_rules"
         if st.button("🦷 Data Processing", key="btn_nav_processing"):
             st.session_state.page = "data_processing"
+        if st.button("📊 Dashboard", key="btn_nav_dashboard"):
+            st.session_state.page = "dashboard"
         st.markdown("---")
         st.markdown("<div style='text-align:center; color: #0b6b61; font-size: 13px;'>"
                     "<p>Version 1.0.0</p>"
@@ -1051,10 +1031,14 @@ def main():
         upload_rules()
     elif page == "data_processing":
         process_data()
+    elif page == "dashboard":
+        dashboard()
     else:
         # fallback
         upload_rules()
 
 if __name__ == "__main__":
+    # stage timings are logged as JSON lines on the 'dental_audit' logger
+    logging.basicConfig(level=os.environ.get('AUDIT_LOG_LEVEL', 'INFO'), format='%(asctime)s %(name)s %(message)s')
     init_db()
     main()
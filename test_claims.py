@@ -0,0 +1,87 @@
+# test_claims.py
+# Reading claims files, whole and in chunks:
+#   python -m pytest -q test_claims.py
+import io
+
+import pandas as pd
+import pytest
+
+import audit_engine as engine
+
+CLAIMS_CSV = (
+    'SSNBR,ADHERENT#,SERVICE,GM ITEM DESCRIPTION,TRX DATE,AGE,QTYAPP,PROV NET CLAIMED\n'
+    '007,00123,IOE,IOE,2024-01-05,30,1,100\n'
+    '007,00123,IOE,IOE,2024-01-20,,,100\n'
+    '0450,00987,FIL,Filling tooth 11,2024-01-07,41,2,\n'
+    '0450,123,EXT,Extraction t 36,,7,1,250.5\n'
+)
+
+
+def plain(data_df):
+    """
+    Text columns as plain objects: chunks are categorized one by one, and
+    the pyarrow and C parsers order categories differently
+    """
+    return data_df.astype({c: object for c in data_df.columns
+                           if isinstance(data_df[c].dtype, pd.CategoricalDtype)
+                           or pd.api.types.is_string_dtype(data_df[c])})
+
+
+@pytest.fixture
+def claims_path(tmp_path):
+    path = tmp_path / 'claims.csv'
+    path.write_text(CLAIMS_CSV, encoding='utf-8-sig')
+    return str(path)
+
+
+def test_blank_numeric_cells(claims_path):
+    claims = engine.load_claims(claims_path)
+    assert claims['AGE'].isna().tolist() == [False, True, False, False]
+    assert claims['QTYAPP'].tolist() == [1, 1, 2, 1]
+    assert claims['PROV NET CLAIMED'].isna().tolist() == [False, False, True, False]
+
+
+@pytest.mark.parametrize('chunksize', [1, 3, 100])
+def test_load_claims_matches_iter_claims(claims_path, chunksize):
+    claims = engine.load_claims(claims_path)
+    assert claims['SSNBR'].tolist() == ['007', '007', '0450', '0450']
+    assert claims['ADHERENT#'].tolist() == ['00123', '00123', '00987', '123']
+
+    chunks = pd.concat(engine.iter_claims(claims_path, chunksize), ignore_index=True)
+    pd.testing.assert_frame_equal(plain(claims), plain(chunks))
+
+
+def test_load_claims_from_streams(claims_path):
+    claims = engine.load_claims(claims_path)
+    with open(claims_path, 'rb') as f:
+        pd.testing.assert_frame_equal(plain(claims), plain(engine.load_claims(io.BytesIO(f.read()))))
+    # text streams go through the C parser
+    with open(claims_path, encoding='utf-8-sig') as f:
+        pd.testing.assert_frame_equal(plain(claims), plain(engine.load_claims(io.StringIO(f.read()))))
+
+
+def test_numeric_codes_as_text():
+    # a code column typed as float (blanks in a numeric column) keys state as '123', not '123.0'
+    claims = engine.normalize_claims(pd.DataFrame({'ADHERENT#': [123.0, None, 45.0], 'SSNBR': [7, 7, 8]}))
+    assert claims['ADHERENT#'].tolist()[::2] == ['123', '45']
+    assert claims['SSNBR'].tolist() == ['7', '7', '8']
+
+
+def test_day_first_dates_detected_from_whole_file(tmp_path):
+    # the first chunks alone (days up to 12) would also parse month-first
+    path = tmp_path / 'day_first.csv'
+    path.write_text('ADHERENT#,SERVICE,TRX DATE\n5,IOE,05/01/2024\n5,IOE,07/01/2024\n5,IOE,20/01/2024\n')
+    expected = ['2024-01-05', '2024-01-07', '2024-01-20']
+    assert engine.load_claims(str(path))['TRX DATE'].dt.strftime('%Y-%m-%d').tolist() == expected
+    chunks = pd.concat(engine.iter_claims(str(path), 1), ignore_index=True)
+    assert chunks['TRX DATE'].dt.strftime('%Y-%m-%d').tolist() == expected
+    with open(path, 'rb') as f:
+        chunks = pd.concat(engine.iter_claims(io.BytesIO(f.read()), 2), ignore_index=True)
+    assert chunks['TRX DATE'].dt.strftime('%Y-%m-%d').tolist() == expected
+
+
+def test_dates_another_format_would_parse_are_reported(caplog):
+    with caplog.at_level('WARNING', logger='dental_audit'):
+        dates = engine.parse_claim_dates(pd.Series(['05/01/2024', '20/01/2024']), '%m/%d/%Y')
+    assert dates.isna().tolist() == [False, True]
+    assert "'20/01/2024'" in caplog.text and '%d/%m/%Y' in caplog.text
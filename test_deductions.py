@@ -0,0 +1,315 @@
+# test_deductions.py
+# The vectorized deduction rules against the original row-by-row loop:
+#   python -m pytest -q test_deductions.py
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import audit_bench
+import audit_engine as engine
+
+
+def reference_apply_deductions(data_df, rules_df):
+    """
+    The iterrows loop apply_deductions replaced (IOE repeat, gum-surgery cap
+    and age rules), kept as the reference. One change: claims are sorted with
+    kind='mergesort', so claims of the same date keep their file order. The
+    original default sort is not stable, and which claim of a tie was charged
+    depended on it.
+    """
+    non_compliant_cases = []
+    processed_pairs = set()
+    gum_surgery_records = {}
+    ioe_records = {}
+
+    if 'TRX DATE' in data_df.columns:
+        data_df = data_df.sort_values('TRX DATE', kind='mergesort')
+
+    for index, row in data_df.iterrows():
+        service = row.get('SERVICE', '')
+        adherent = row.get('ADHERENT#', '')
+        trx_date = row.get('TRX DATE') if pd.notna(row.get('TRX DATE')) else None
+        prov_net_claimed = float(row.get('PROV NET CLAIMED')) if pd.notna(row.get('PROV NET CLAIMED')) else 0
+        prov_desc = str(row.get('PROV ITEM DESC MAPPING', ''))
+        age = int(row.get('AGE')) if pd.notna(row.get('AGE')) else 0
+        tooth_num = row.get('EXTRACTED_TOOTH')
+        quantity = int(row.get('QTYAPP')) if pd.notna(row.get('QTYAPP')) and row.get('QTYAPP') != 0 else 1
+
+        # Rule 1: IOE repeat less than 30 days
+        if service == 'IOE' and trx_date is not None:
+            if adherent in ioe_records:
+                last_date, _ = ioe_records[adherent]
+                if (trx_date - last_date) < timedelta(days=30):
+                    non_compliant_cases.append({
+                        'SSNBR': row.get('SSNBR', ''),
+                        'ADHERENT#': adherent,
+                        'SERVICE': service,
+                        'GM_ITEM_DESCRIPTION': row.get('GM ITEM DESCRIPTION', ''),
+                        'PROV_ITEM_DESC': prov_desc,
+                        'TOOTH_NUMBER': tooth_num,
+                        'PATIENT_AGE': age,
+                        'TRX DATE': trx_date.strftime('%Y-%m-%d') if trx_date else '',
+                        'PREVIOUS_DATE': last_date.strftime('%Y-%m-%d') if last_date else '',
+                        'PROV_NET_CLAIMED': prov_net_claimed,
+                        'QTYAPP': quantity,
+                        'REASON': 'Follow-up'
+                    })
+            ioe_records[adherent] = (trx_date, index)
+
+        # Rule 2: specific gum surgery limit
+        if 'جراحة اللثة الصديدية' in prov_desc:
+            if adherent in gum_surgery_records:
+                gum_surgery_records[adherent]['total_qty'] += quantity
+                total_qty = gum_surgery_records[adherent]['total_qty']
+                if total_qty > 2:
+                    excess_qty = min(total_qty - 2, quantity)
+                    amount_to_deduct = (prov_net_claimed / quantity) * excess_qty if quantity != 0 else 0
+                    non_compliant_cases.append({
+                        'SSNBR': row.get('SSNBR', ''),
+                        'ADHERENT#': adherent,
+                        'SERVICE': service,
+                        'GM_ITEM_DESCRIPTION': row.get('GM ITEM DESCRIPTION', ''),
+                        'PROV_ITEM_DESC': prov_desc,
+                        'TOOTH_NUMBER': tooth_num,
+                        'PATIENT_AGE': age,
+                        'TRX DATE': trx_date.strftime('%Y-%m-%d') if trx_date else '',
+                        'TOTAL_QUANTITY': total_qty,
+                        'EXCESS_QUANTITY': excess_qty,
+                        'PROV_NET_CLAIMED': amount_to_deduct,
+                        'QTYAPP': quantity,
+                        'REASON': f'تجاوز حد جراحة اللثة (الحد الأقصى 2، الكمية الإجمالية {total_qty})'
+                    })
+            else:
+                gum_surgery_records[adherent] = {'total_qty': quantity}
+
+        # Rule 3: age mismatch (requires rules)
+        if pd.isna(tooth_num) or tooth_num is None:
+            continue
+        case_id = (row.get('SSNBR', ''), adherent, service, tooth_num)
+        if case_id in processed_pairs:
+            continue
+
+        if not rules_df.empty:
+            matching_rules = rules_df[
+                (rules_df['serv_cat'] == service) &
+                (rules_df['tooth_number'] == tooth_num)
+            ]
+            if not matching_rules.empty:
+                rule = matching_rules.iloc[0]
+                min_age = int(rule['min_patient_age']) if pd.notna(rule.get('min_patient_age')) else 0
+                max_age = int(rule['max_patient_age']) if pd.notna(rule.get('max_patient_age')) else 120
+                if age < min_age or age > max_age:
+                    non_compliant_cases.append({
+                        'SSNBR': row.get('SSNBR', ''),
+                        'ADHERENT#': adherent,
+                        'SERVICE': service,
+                        'GM_ITEM_DESCRIPTION': row.get('GM ITEM DESCRIPTION', ''),
+                        'TOOTH_NUMBER': tooth_num,
+                        'PATIENT_AGE': age,
+                        'TRX DATE': trx_date.strftime('%Y-%m-%d') if trx_date else '',
+                        'PROV_NET_CLAIMED': prov_net_claimed,
+                        'QTYAPP': quantity,
+                        'REASON': 'incompatible age'
+                    })
+                    processed_pairs.add(case_id)
+
+    return pd.DataFrame(non_compliant_cases) if non_compliant_cases else pd.DataFrame()
+
+
+# the rules the original loop implemented; duplicate_claims came later
+ORIGINAL_RULES = engine.DEFAULT_DEDUCTION_RULES[engine.DEFAULT_DEDUCTION_RULES['kind'] != 'duplicate_claims']
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_apply_deductions_matches_reference_loop(seed):
+    # a short period so that IOE repeats and gum-surgery caps are frequent
+    claims = engine.normalize_claims(audit_bench.generate_claims(3_000, seed=seed, days=60))
+    rules_df = audit_bench.generate_rules(seed).rename(columns=engine.RULES_CSV_COLUMNS)
+    plan = engine.compile_deduction_rules(ORIGINAL_RULES, engine.AgeRuleIndex.from_rules(rules_df))
+
+    expected = reference_apply_deductions(claims, rules_df)
+    result = engine.apply_deductions(claims, plan=plan)
+
+    # every rule fires on the seeded claims
+    assert expected['REASON'].str[:10].nunique() == 3
+    pd.testing.assert_frame_equal(result, expected)
+
+
+GUM_SURGERY = 'جراحة اللثة الصديدية'
+
+
+def claims_frame(**columns):
+    """Normalised claims of one adherent; columns given as lists override the defaults"""
+    rows = len(columns['TRX DATE'])
+    raw = pd.DataFrame({'SSNBR': ['1'] * rows, 'ADHERENT#': ['7'] * rows, 'SERVICE': ['SUR'] * rows,
+                        'GM ITEM DESCRIPTION': ['Gum surgery'] * rows, 'PROV ITEM DESC MAPPING': [GUM_SURGERY] * rows,
+                        'AGE': [30.0] * rows, 'QTYAPP': [1.0] * rows, 'PROV NET CLAIMED': [100.0] * rows})
+    for column, values in columns.items():
+        raw[column] = values
+    raw['TRX DATE'] = pd.to_datetime(raw['TRX DATE'])
+    return engine.normalize_claims(raw)
+
+
+def test_overlapping_rules_match_reference_loop():
+    # the second claim is over the gum-surgery cap (pro rata) and fails the age rule (in full)
+    claims = claims_frame(**{'TRX DATE': ['2024-01-01', '2024-02-01', '2024-03-01'],
+                             'GM ITEM DESCRIPTION': ['Gum surgery', 'Gum surgery tooth 11', 'Gum surgery tooth 11'],
+                             'AGE': [8.0] * 3, 'QTYAPP': [1.0, 2.0, 3.0], 'PROV NET CLAIMED': [400.0, 800.0, 1200.0]})
+    rules_df = pd.DataFrame({'serv_cat': ['SUR'], 'tooth_number': [11.0],
+                             'min_patient_age': [18], 'max_patient_age': [90]})
+    plan = engine.compile_deduction_rules(ORIGINAL_RULES, engine.AgeRuleIndex.from_rules(rules_df))
+
+    expected = reference_apply_deductions(claims, rules_df)
+    result = engine.apply_deductions(claims, plan=plan)
+
+    assert expected['PROV_NET_CLAIMED'].tolist() == [400.0, 800.0, 1200.0]
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_duplicate_claim_deducted_once():
+    plan = engine.compile_deduction_rules(engine.DEFAULT_DEDUCTION_RULES)
+
+    # a repeated IOE is a follow-up and a duplicate: the follow-up deducts it in full
+    claims = claims_frame(**{'TRX DATE': ['2024-03-01', '2024-03-02'], 'SERVICE': ['IOE'] * 2,
+                             'PROV ITEM DESC MAPPING': ['IOE'] * 2})
+    result = engine.apply_deductions(claims, plan=plan)
+    assert result[['TRX DATE', 'PROV_NET_CLAIMED', 'REASON']].values.tolist() == [['2024-03-02', 100.0, 'Follow-up']]
+
+    # the duplicate's full amount replaces the smaller pro-rata gum-surgery deduction
+    claims = claims_frame(**{'TRX DATE': ['2024-01-01', '2024-01-02'], 'QTYAPP': [1.0, 2.0],
+                             'PROV NET CLAIMED': [600.0, 600.0]})
+    result = engine.apply_deductions(claims, plan=plan)
+    assert result[['TRX DATE', 'PROV_NET_CLAIMED', 'REASON']].values.tolist() == [
+        ['2024-01-02', 600.0, 'Duplicate claim (1 days apart)']]
+
+
+PERIOD_HEADER = 'SSNBR,ADHERENT#,SERVICE,GM ITEM DESCRIPTION,TRX DATE,AGE,QTYAPP,PROV NET CLAIMED\n'
+
+
+def test_incremental_periods_mix_streamed_and_whole_file(tmp_path):
+    # zero-padded IDs must key the saved state the same way whichever reader produced them
+    periods = ['007,00123,IOE,IOE,2024-01-25,30,1,100\n',
+               '007,00123,IOE,IOE,2024-02-05,30,1,100\n']
+    paths = []
+    for i, rows in enumerate(periods):
+        paths.append(tmp_path / f'p{i}.csv')
+        paths[-1].write_text(PERIOD_HEADER + rows)
+    db = str(tmp_path / 'rules.db')
+    plan = engine.compile_deduction_rules(ORIGINAL_RULES)
+
+    state = engine.load_deduction_state(db_name=db)
+    first = engine.apply_deductions_streaming(str(paths[0]), chunksize=1, plan=plan, state=state)
+    engine.commit_deduction_state(state, 'p0', db_name=db)
+    second = engine.apply_deductions_incremental(engine.load_claims(str(paths[1])), 'p1', plan=plan, db_name=db)
+
+    full = engine.apply_deductions(pd.concat([engine.load_claims(str(p)) for p in paths], ignore_index=True), plan=plan)
+    assert first.empty
+    assert second[['ADHERENT#', 'TRX DATE', 'REASON']].values.tolist() == [['00123', '2024-02-05', 'Follow-up']]
+    assert full[['ADHERENT#', 'TRX DATE', 'REASON']].values.tolist() == [['00123', '2024-02-05', 'Follow-up']]
+
+
+# scalings: at most 2 in any 30 days per adherent
+SCALING_RULE = pd.DataFrame([{'rule_id': 'scaling', 'kind': 'frequency_limit', 'service': 'CL',
+                              'window_days': 30, 'max_quantity': 2}])
+
+
+def repeated_claims(seed, rows=2_000):
+    """Bench claims over 60 days, a share of them billed again up to 4 days later"""
+    claims = audit_bench.generate_claims(rows, seed=seed, days=60)
+    repeats = claims.sample(frac=0.05, random_state=seed)
+    days = np.random.default_rng(seed).integers(0, 5, len(repeats))
+    repeats['TRX DATE'] = repeats['TRX DATE'] + pd.to_timedelta(days, unit='D')
+    return pd.concat([claims, repeats], ignore_index=True)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_frequency_limit_matches_brute_force(seed):
+    window_days, max_quantity = 14, 3
+    plan = engine.compile_deduction_rules(pd.DataFrame([{'rule_id': 'frequency', 'kind': 'frequency_limit',
+                                                         'window_days': window_days, 'max_quantity': max_quantity}]))
+    claims = engine.normalize_claims(repeated_claims(seed))
+    result = engine.apply_deductions(claims, plan=plan)
+
+    # every claim against the claims of its adherent and service in the window ending on its day
+    prepared = engine.prepare_claims(claims)
+    prepared = prepared[prepared['TRX_DATE'].notna()]
+    prepared['DAY'] = prepared['TRX_DATE'].dt.normalize()
+    expected = []
+    for _, group in prepared.groupby(['ADHERENT#', 'SERVICE'], observed=True):
+        for position, claim in group.iterrows():
+            window = group[(group.index <= position) & (group['DAY'] > claim['DAY'] - pd.Timedelta(days=window_days))]
+            total = int(window['QTYAPP'].sum())
+            excess = min(total - max_quantity, claim['QTYAPP'])
+            if excess > 0:
+                expected.append((position, total, excess, claim['PROV_NET_CLAIMED'] / claim['QTYAPP'] * excess))
+    expected.sort()
+
+    assert len(expected) > 50
+    assert result['TOTAL_QUANTITY'].tolist() == [e[1] for e in expected]
+    assert result['EXCESS_QUANTITY'].tolist() == [e[2] for e in expected]
+    np.testing.assert_allclose(result['PROV_NET_CLAIMED'], [e[3] for e in expected])
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_duplicate_claims_match_brute_force(seed):
+    window_days = 3
+    plan = engine.compile_deduction_rules(pd.DataFrame([{'rule_id': 'duplicates', 'kind': 'duplicate_claims',
+                                                         'window_days': window_days}]))
+    claims = engine.normalize_claims(repeated_claims(seed))
+    result = engine.apply_deductions(claims, plan=plan)
+
+    # every claim against the last earlier claim of the same adherent, service, tooth and amount
+    prepared = engine.prepare_claims(claims)
+    prepared = prepared[prepared['TRX_DATE'].notna()]
+    expected, last_days = [], {}
+    for position, claim in prepared.iterrows():
+        tooth = claim['TOOTH_NUMBER']
+        key = (claim['ADHERENT#'], claim['SERVICE'], None if pd.isna(tooth) else tooth,
+               round(claim['PROV_NET_CLAIMED'], 2))
+        day = claim['TRX_DATE'].normalize()
+        if key in last_days and (day - last_days[key]).days <= window_days:
+            expected.append((claim['TRX DATE'], last_days[key].strftime('%Y-%m-%d'), (day - last_days[key]).days))
+        last_days[key] = day
+
+    assert len(expected) > 50
+    assert list(result[['TRX DATE', 'ORIGINAL_DATE', 'DAYS_APART']].itertuples(index=False, name=None)) == expected
+
+
+def test_streaming_and_parallel_match_apply_deductions(tmp_path, monkeypatch):
+    rules_df = audit_bench.generate_rules(0).rename(columns=engine.RULES_CSV_COLUMNS)
+    plan = engine.compile_deduction_rules(pd.concat([engine.DEFAULT_DEDUCTION_RULES, SCALING_RULE]),
+                                          engine.AgeRuleIndex.from_rules(rules_df))
+    # in no particular order, as exports come
+    path = tmp_path / 'claims.csv'
+    repeated_claims(0, rows=5_000).sample(frac=1, random_state=0).to_csv(path, index=False)
+    claims = engine.load_claims(str(path))
+    expected = engine.apply_deductions(claims, plan=plan)
+    assert expected['REASON'].str[:10].nunique() == 5
+
+    for chunksize in (97, 1_000, 100_000):
+        pd.testing.assert_frame_equal(engine.apply_deductions_streaming(str(path), chunksize=chunksize, plan=plan),
+                                      expected)
+    monkeypatch.setattr(engine, 'PARALLEL_MIN_ROWS', 0)
+    for workers in (2, 3):
+        pd.testing.assert_frame_equal(engine.apply_deductions_parallel(claims, workers=workers, plan=plan), expected)
+
+
+def test_incremental_periods_match_full_audit(tmp_path):
+    # the age rule reports a tooth once per run, so it is left out
+    rules = engine.DEFAULT_DEDUCTION_RULES[engine.DEFAULT_DEDUCTION_RULES['kind'] != 'age_tooth_bounds']
+    plan = engine.compile_deduction_rules(pd.concat([rules, SCALING_RULE]))
+    claims = engine.normalize_claims(repeated_claims(2, rows=5_000))
+    expected = engine.apply_deductions(claims, plan=plan)
+
+    # three periods in date order; claims without a date come with the last
+    dates = claims['TRX DATE']
+    periods = [claims[dates < '2024-01-20'], claims[(dates >= '2024-01-20') & (dates < '2024-02-10')],
+               claims[~(dates < '2024-02-10')]]
+    db = str(tmp_path / 'rules.db')
+    result = pd.concat([engine.apply_deductions_incremental(period, f'p{i}', plan=plan, db_name=db)
+                        for i, period in enumerate(periods)], ignore_index=True)
+
+    assert len(expected) > 100
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_categorical=False)